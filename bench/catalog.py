@@ -0,0 +1,138 @@
+"""Сравнение локального каталога треков с живым Deezer API.
+
+Заполняет каталог ответами Deezer на список запросов, затем для тех же
+запросов и их вариантов с опечатками сравнивает задержку и совпадение
+результатов каталога с выдачей API.
+
+Пример:
+    python bench/catalog.py --queries 200 --typos 2
+    python bench/catalog.py --offline
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from run import QUERIES, FakeServerState, start_fake_server, percentile
+
+def make_typo(rng, query):
+    """Одна опечатка: пропуск, замена или перестановка соседних букв"""
+    chars = list(query)
+    positions = [i for i, ch in enumerate(chars) if ch.isalpha()]
+    if len(positions) < 4:
+        return query
+    i = rng.choice(positions[1:-1])
+    kind = rng.choice(['drop', 'replace', 'swap'])
+    if kind == 'drop':
+        del chars[i]
+    elif kind == 'replace':
+        chars[i] = rng.choice('aeiouy' if chars[i].isascii() else 'аеиоуя')
+    else:
+        chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    return ''.join(chars)
+
+def overlap(found, expected):
+    """Доля ожидаемых треков, которые нашлись"""
+    expected_ids = {str(track.id) for track in expected}
+    if not expected_ids:
+        return None
+    return len(expected_ids & {str(track.id) for track in found}) / len(expected_ids)
+
+def report(name, latencies, scores):
+    scores = [score for score in scores if score is not None]
+    quality = sum(scores) / len(scores) if scores else 0.0
+    print(
+        f'{name:<22}{len(latencies):>6}{percentile(latencies, 0.50) * 1000:>10.2f}'
+        f'{percentile(latencies, 0.95) * 1000:>10.2f}{max(latencies, default=0) * 1000:>10.2f}{quality:>10.2f}'
+    )
+
+async def run_benchmark(args):
+    if args.offline:
+        server = start_fake_server(FakeServerState(args.deezer_delay, 0))
+        os.environ['DEEZER_API'] = f'http://127.0.0.1:{server.server_address[1]}'
+    elif args.api:
+        os.environ['DEEZER_API'] = args.api
+    os.environ.setdefault('BOT_TOKEN', '123456:bench')
+    os.environ['CACHE_DB'] = os.path.join(tempfile.mkdtemp(), 'catalog.db')
+
+    import main as bot_main
+
+    rng = random.Random(args.seed)
+    # Заполняем каталог ответами API; запросы дополняем артистами из ответов
+    expected = {}
+    api_latencies = []
+    for query in QUERIES:
+        started = time.perf_counter()
+        expected[query] = await bot_main.fetch_search(bot_main.normalize_query(query), 10)
+        api_latencies.append(time.perf_counter() - started)
+        for track in expected[query][:args.expand]:
+            if len(expected) >= args.queries:
+                break
+            artist_query = bot_main.normalize_query(track.artist)
+            if artist_query not in expected:
+                started = time.perf_counter()
+                expected[artist_query] = await bot_main.fetch_search(artist_query, 10)
+                api_latencies.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    await bot_main.track_catalog.flush_async()
+    print(f'Catalog: {bot_main.track_catalog.size} tracks from {len(expected)} queries, indexed in {time.perf_counter() - started:.2f}s')
+
+    catalog_latencies, catalog_scores = [], []
+    typo_latencies, typo_scores = [], []
+    typo_api_latencies, typo_api_scores = [], []
+    confident = 0
+    for query, api_results in expected.items():
+        started = time.perf_counter()
+        found = bot_main.track_catalog.search(query)
+        catalog_latencies.append(time.perf_counter() - started)
+        catalog_scores.append(overlap([track for _, _, track in found], api_results))
+        if len([
+            track for score, coverage, track in found
+            if score >= bot_main.CATALOG_CONFIDENCE and coverage >= bot_main.CATALOG_COVERAGE
+        ]) >= bot_main.CATALOG_MIN_RESULTS:
+            confident += 1
+
+        for _ in range(args.typos):
+            typo = make_typo(rng, query)
+            started = time.perf_counter()
+            found = bot_main.track_catalog.search(typo)
+            typo_latencies.append(time.perf_counter() - started)
+            typo_scores.append(overlap([track for _, _, track in found], api_results))
+
+            # Живой API на тот же запрос с опечаткой
+            started = time.perf_counter()
+            live = await bot_main.fetch_search(bot_main.normalize_query(typo), 10)
+            typo_api_latencies.append(time.perf_counter() - started)
+            typo_api_scores.append(overlap(live, api_results))
+
+    print(f'{"source":<22}{"count":>6}{"p50 ms":>10}{"p95 ms":>10}{"max ms":>10}{"recall":>10}')
+    report('deezer api', api_latencies, [1.0] * len(api_latencies))
+    report('catalog', catalog_latencies, catalog_scores)
+    report('deezer api, typo', typo_api_latencies, typo_api_scores)
+    report('catalog, typo', typo_latencies, typo_scores)
+    print(f'Confident catalog answers: {confident} of {len(expected)} queries')
+    print(f'Circuits: { {name: b.state for name, b in bot_main.breakers.items()} }')
+
+    client = bot_main.http_client
+    if client is not None:
+        await client.aclose()
+
+def main():
+    parser = argparse.ArgumentParser(description='Local track catalog vs the Deezer API')
+    parser.add_argument('--api', default='https://api.deezer.com', help='Deezer API base URL')
+    parser.add_argument('--offline', action='store_true', help='use the stub Deezer from run.py')
+    parser.add_argument('--queries', type=int, default=100, help='queries used to fill the catalog')
+    parser.add_argument('--expand', type=int, default=3, help='artists from each answer searched again')
+    parser.add_argument('--typos', type=int, default=2, help='typo variants per query')
+    parser.add_argument('--deezer-delay', type=float, default=0.05, help='stub Deezer latency with --offline')
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(run_benchmark(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+#!/usr/bin/env python
+"""Заглушка ffprobe для бенчмарка: всегда сообщает одинаковую длительность"""
+print('180.0')
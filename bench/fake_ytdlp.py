@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Заглушка yt-dlp для бенчмарка: ждет и пишет файл заданного размера"""
+import os
+import json
+import re
+import sys
+import time
+import hashlib
+
+DELAY = float(os.environ.get('BENCH_YTDLP_DELAY', 2))
+FILE_SIZE = int(os.environ.get('BENCH_FILE_SIZE', 5 * 1024 * 1024))
+FAIL_RATE = float(os.environ.get('BENCH_YTDLP_FAIL_RATE', 0))
+
+def main(argv):
+    target = argv[-1]
+    if '-J' in argv:
+        # Метаданные: один формат со звуком размером BENCH_FILE_SIZE
+        time.sleep(DELAY / 10)
+        print(json.dumps({'duration': 15, 'formats': [
+            {'format_id': 'h264', 'ext': 'mp4', 'vcodec': 'h264', 'acodec': 'aac', 'height': 1280, 'tbr': 1000, 'filesize': FILE_SIZE}
+        ]}))
+        return 0
+
+    outtmpl = argv[argv.index('-o') + 1]
+
+    match = re.search(r'[?&]v=([\w-]+)', target)
+    video_id = match.group(1) if match else hashlib.md5(target.encode()).hexdigest()[:11]
+    if '--extract-audio' in argv:
+        ext = 'mp3' if argv[argv.index('--audio-format') + 1] == 'mp3' else 'm4a'
+    else:
+        ext = 'mp4'
+
+    time.sleep(DELAY)
+    if FAIL_RATE and int(hashlib.md5(target.encode()).hexdigest(), 16) % 1000 < FAIL_RATE * 1000:
+        sys.stderr.write('ERROR: Video unavailable\n')
+        return 1
+
+    path = outtmpl.replace('%(id)s', video_id).replace('%(ext)s', ext)
+    chunk = b'\0' * (1024 * 1024)
+    with open(path, 'wb') as f:
+        remaining = FILE_SIZE
+        while remaining > 0:
+            f.write(chunk[:remaining])
+            remaining -= len(chunk)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,368 @@
+"""Нагрузочный тест бота без сети.
+
+Поднимает локальные заглушки Telegram Bot API и Deezer /search, подменяет
+yt-dlp и ffprobe скриптами из этой папки и прогоняет через настоящие
+обработчики main.py смесь поисков, нажатий кнопок, ссылок на видео и
+inline-запросов.
+
+Пример:
+    python bench/run.py --rate 20 --duration 60 --users 50 --file-size 5000000
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import hashlib
+import resource
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+QUERIES = [
+    'miyagi', 'zivert life', 'баста сансара', 'jony комета', 'hammali navai',
+    'скриптонит', 'элджей', 'моргенштерн', 't-fest', 'instasamka',
+    'rauf faik', 'macan', 'andro', 'xcho', 'mona', 'artik asti'
+]
+
+# Заглушки внешних сервисов
+class FakeServerState:
+    def __init__(self, deezer_delay, api_delay):
+        self.deezer_delay = deezer_delay
+        self.api_delay = api_delay
+        self.lock = threading.Lock()
+        self.message_id = 0
+        self.uploaded_bytes = 0
+        self.calls = {}
+
+    def next_message_id(self):
+        with self.lock:
+            self.message_id += 1
+            return self.message_id
+
+    def count(self, method, size):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.uploaded_bytes += size
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def read_body(self):
+            """Возвращает (размер, начало тела) - целиком тело не храним"""
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                size = 0
+                head = b''
+                while True:
+                    length = int(self.rfile.readline().strip(), 16)
+                    if length == 0:
+                        self.rfile.readline()
+                        return size, head
+                    chunk = self.rfile.read(length)
+                    if len(head) < 65536:
+                        head += chunk[:65536]
+                    self.rfile.readline()
+                    size += length
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            return length, body[:65536]
+
+        def send_json(self, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            if parts.path == '/search':
+                time.sleep(state.deezer_delay)
+                params = parse_qs(parts.query)
+                query = params.get('q', [''])[0]
+                limit = int(params.get('limit', ['10'])[0])
+                seed = int(hashlib.md5(query.encode()).hexdigest()[:8], 16)
+                self.send_json({'data': [
+                    {
+                        'id': seed + i,
+                        'title': f'{query} #{i}',
+                        'duration': 150 + i,
+                        'link': f'https://www.deezer.com/track/{seed + i}',
+                        'artist': {'name': f'Artist {seed % 97}'}
+                    }
+                    for i in range(limit)
+                ]})
+                return
+            self.send_json({'ok': False, 'description': 'Not Found'})
+
+        def do_POST(self):
+            method = self.path.rsplit('/', 1)[-1]
+            size, head = self.read_body()
+            state.count(method, size)
+            time.sleep(state.api_delay)
+            if method == 'sendMediaGroup':
+                # Поле media - JSON-список, по одному сообщению на элемент
+                count = max(1, len(re.findall(rb'"type":\s*"video"', head)))
+                self.send_json({'ok': True, 'result': [fake_result(state, 'sendVideo') for _ in range(count)]})
+                return
+            self.send_json({'ok': True, 'result': fake_result(state, method)})
+
+    return Handler
+
+def fake_result(state, method):
+    user = {'id': 1, 'is_bot': False, 'first_name': 'bench'}
+    if method == 'getMe':
+        return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+    if method == 'getChatMember':
+        return {'status': 'member', 'user': user}
+    if method in ('sendMessage', 'editMessageText', 'sendAudio', 'sendVideo'):
+        message_id = state.next_message_id()
+        message = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}}
+        if method == 'sendAudio':
+            message['audio'] = {'file_id': f'audio{message_id}', 'file_unique_id': f'a{message_id}', 'duration': 180}
+        if method == 'sendVideo':
+            message['video'] = {
+                'file_id': f'video{message_id}', 'file_unique_id': f'v{message_id}',
+                'width': 720, 'height': 1280, 'duration': 15
+            }
+        return message
+    return True
+
+def start_fake_server(state):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def prepare_environment(args, port):
+    # ffprobe из PATH подменяется заглушкой
+    bin_dir = tempfile.mkdtemp()
+    os.symlink(os.path.join(BENCH_DIR, 'fake_ffprobe.py'), os.path.join(bin_dir, 'ffprobe'))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    os.environ.update({
+        'BOT_TOKEN': '123456:bench',
+        'CHANNELS': '@bench_channel',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{port}',
+        'DEEZER_API': f'http://127.0.0.1:{port}',
+        'CACHE_DB': os.path.join(tempfile.mkdtemp(), 'bench.db'),
+        'YTDLP_ENGINE': 'subprocess',
+        'YTDLP_BIN': os.path.join(BENCH_DIR, 'fake_ytdlp.py'),
+        'BENCH_YTDLP_DELAY': str(args.download_delay),
+        'BENCH_FILE_SIZE': str(args.file_size),
+        'BENCH_YTDLP_FAIL_RATE': str(args.fail_rate)
+    })
+
+# Генерация обновлений
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+    def message(self, user_id, text):
+        from telegram import Update
+        self.update_id += 1
+        return Update.de_json({
+            'update_id': self.update_id,
+            'message': {
+                'message_id': self.update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': self.user(user_id),
+                'text': text
+            }
+        }, self.bot)
+
+    def inline(self, user_id, query, offset=''):
+        from telegram import Update
+        self.update_id += 1
+        return Update.de_json({
+            'update_id': self.update_id,
+            'inline_query': {
+                'id': str(self.update_id),
+                'from': self.user(user_id),
+                'query': query,
+                'offset': offset
+            }
+        }, self.bot)
+
+    def callback(self, user_id, data):
+        from telegram import Update
+        self.update_id += 1
+        return Update.de_json({
+            'update_id': self.update_id,
+            'callback_query': {
+                'id': str(self.update_id),
+                'from': self.user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': self.update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'},
+                    'text': 'results'
+                }
+            }
+        }, self.bot)
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def monitor_loop_lag(samples, interval=0.05):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+async def run_benchmark(args):
+    state = FakeServerState(args.deezer_delay, args.api_delay)
+    server = start_fake_server(state)
+    prepare_environment(args, server.server_address[1])
+
+    import main as bot_main
+
+    application = bot_main.build_application()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    factory = UpdateFactory(application.bot)
+    mix = parse_mix(args.mix)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    rng = random.Random(args.seed)
+    searched = set()
+
+    latencies = {}
+    errors = {}
+    lag_samples = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lag_samples))
+
+    # process_update не пробрасывает ошибки обработчиков, а отдает их error handler
+    failures = {}
+
+    async def record_error(update, context):
+        if update is not None:
+            failures[update.update_id] = context.error
+
+    application.add_error_handler(record_error)
+
+    async def drive(kind, update):
+        started = time.perf_counter()
+        try:
+            await application.process_update(update)
+        except Exception as e:
+            failures[update.update_id] = e
+        error = failures.pop(update.update_id, None)
+        if error is not None:
+            errors[kind] = errors.get(kind, 0) + 1
+            if args.verbose:
+                print(f'{kind} failed: {error!r}')
+        latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    tasks = []
+    total = int(args.rate * args.duration)
+    bench_started = time.perf_counter()
+    for i in range(total):
+        # Равномерная подача с заданной частотой
+        delay = bench_started + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        user_id = 1000 + rng.randrange(args.users)
+        kind = rng.choices(kinds, weights)[0]
+        if kind == 'button' and user_id not in searched:
+            kind = 'search'
+        if kind == 'search':
+            searched.add(user_id)
+            update = factory.message(user_id, rng.choice(QUERIES))
+        elif kind == 'button':
+            update = factory.callback(user_id, f'download_{rng.randrange(10)}')
+        elif kind == 'inline':
+            # Половина inline-запросов - следующая страница
+            update = factory.inline(user_id, rng.choice(QUERIES), rng.choice(['', '10']))
+        elif kind == 'links':
+            # Несколько ссылок в одном сообщении - ответ альбомом
+            links = [f'https://www.tiktok.com/@bench/video/{rng.randrange(args.videos)}' for _ in range(rng.randint(2, 8))]
+            update = factory.message(user_id, '\n'.join(links))
+        else:
+            update = factory.message(user_id, f'https://www.tiktok.com/@bench/video/{rng.randrange(args.videos)}')
+        tasks.append(asyncio.create_task(drive(kind, update)))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - bench_started
+    lag_task.cancel()
+
+    await application.stop()
+    await application.shutdown()
+    server.shutdown()
+
+    # Отчет
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f'Updates: {total} in {elapsed:.1f}s ({total / elapsed:.1f} updates/sec, target {args.rate})')
+    print(f'{"handler":<10}{"count":>8}{"errors":>8}{"p50":>9}{"p95":>9}{"p99":>9}{"max":>9}')
+    for kind, samples in sorted(latencies.items()):
+        print(
+            f'{kind:<10}{len(samples):>8}{errors.get(kind, 0):>8}'
+            f'{percentile(samples, 0.50):>9.3f}{percentile(samples, 0.95):>9.3f}'
+            f'{percentile(samples, 0.99):>9.3f}{max(samples):>9.3f}'
+        )
+    print(f'Peak RSS: bot {own:.1f} MB, largest child {children:.1f} MB')
+    print(
+        f'Event loop lag: p50 {percentile(lag_samples, 0.50) * 1000:.1f} ms, '
+        f'p99 {percentile(lag_samples, 0.99) * 1000:.1f} ms, max {max(lag_samples, default=0) * 1000:.1f} ms'
+    )
+    print(f'Download pool: {bot_main.download_pool.stats()}')
+    print(f'Coalesced downloads: {bot_main.download_flights.stats()}')
+    print(f'File cache: {bot_main.file_cache.stats()}')
+    print(f'Search cache: {bot_main.search_cache.stats()}')
+    print(f'Track catalog: {bot_main.track_catalog.stats()}')
+    print(f'Circuits: { {name: (b.state, b.trips, b.rejected) for name, b in bot_main.breakers.items()} }')
+    print(f'Uploaded to fake Bot API: {state.uploaded_bytes / 1024 / 1024:.1f} MB, calls {state.calls}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for the bot handlers')
+    parser.add_argument('--rate', type=float, default=10, help='updates per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--videos', type=int, default=100, help='distinct video links')
+    parser.add_argument('--mix', default='search=0.5,button=0.35,video=0.15', help='weights of search, button, video, links and inline updates')
+    parser.add_argument('--file-size', type=int, default=5 * 1024 * 1024, help='bytes written by the stub yt-dlp')
+    parser.add_argument('--download-delay', type=float, default=2, help='seconds the stub yt-dlp sleeps')
+    parser.add_argument('--fail-rate', type=float, default=0, help='share of stub downloads that fail')
+    parser.add_argument('--deezer-delay', type=float, default=0.05)
+    parser.add_argument('--api-delay', type=float, default=0.02, help='fake Bot API latency per call')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true')
+    asyncio.run(run_benchmark(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
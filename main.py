@@ -1,13 +1,32 @@
 import os
 import logging
 import re
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-import requests
-from flask import Flask
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, InputMediaVideo,
+    InlineQueryResultCachedAudio, InlineQueryResultArticle, InputTextMessageContent, InlineQueryResultsButton
+)
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ChatMemberHandler, InlineQueryHandler, ContextTypes, filters
+import httpx
+from flask import Flask, request, Response
+import functools
+import secrets
+from contextlib import contextmanager
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 import threading
-import subprocess
 import tempfile
+import shutil
+import multiprocessing
+import resource
+import glob
+import ytdlp_worker
+import asyncio
+import time
+import json
+import sqlite3
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from telegram.error import TelegramError
 
 # Настройка логирования
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -24,9 +43,59 @@ def run_flask():
     port = int(os.environ.get('PORT', 10000))
     app.run(host='0.0.0.0', port=port)
 
+# Метрики Prometheus
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+HANDLER_LATENCY = Histogram('bot_handler_seconds', 'Handler latency', ['handler'], buckets=LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram('bot_stage_seconds', 'Latency of a processing stage', ['stage'], buckets=LATENCY_BUCKETS)
+ERRORS = Counter('bot_errors_total', 'Errors by cause', ['cause'])
+BYTES_DOWNLOADED = Counter('bot_downloaded_bytes_total', 'Bytes downloaded by yt-dlp', ['kind'])
+BYTES_UPLOADED = Counter('bot_uploaded_bytes_total', 'Bytes uploaded to Telegram', ['kind'])
+
+@app.route('/metrics')
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+def instrumented(handler):
+    """Декоратор: время работы обработчика и необработанные исключения"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                ERRORS.labels(f'{handler}_exception').inc()
+                raise
+            finally:
+                HANDLER_LATENCY.labels(handler).observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - started)
+
 # Токен бота (замените на свой)
 BOT_TOKEN = os.environ.get('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 
+# Свой сервер Bot API (локальный telegram-bot-api или тестовый), например http://127.0.0.1:8081
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '').rstrip('/')
+
+# Способ получения обновлений: 'polling' или 'webhook'
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+# Публичный адрес сервиса, например https://my-bot.onrender.com
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+# Без заданного секрета генерируем свой: set_webhook передает его Telegram при каждом запуске
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+# Сколько обновлений обрабатывается одновременно
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', 64))
+
 # ID обязательных каналов для подписки
 REQUIRED_CHANNELS = os.environ.get('CHANNELS', '').split(',')
 
@@ -48,7 +117,15 @@ TEXTS = {
         'top': '🔥 Топ хиты сегодня:\n\nНажмите на кнопку для скачивания:',
         'check_sub': '✅ Проверить подписку',
         'video_success': '✅ Видео успешно скачано!',
-        'video_error': '❌ Не удалось скачать видео. Попробуйте другую ссылку.'
+        'video_error': '❌ Не удалось скачать видео. Попробуйте другую ссылку.',
+        'queued': '⏳ Вы #{} в очереди, подождите...',
+        'busy': '⏳ Сейчас слишком много загрузок. Попробуйте через минуту.',
+        'throttled': '⏳ Вы отправили слишком много запросов. Подождите немного и попробуйте снова.',
+        'expired': '⌛ Результаты устарели. Повторите поиск.',
+        'too_large': '❌ Видео слишком большое для отправки в Telegram (лимит {} МБ).',
+        'videos_failed': '❌ Не удалось скачать:\n{}',
+        'unavailable': '⚠️ Сервис временно недоступен. Попробуйте через пару минут.',
+        'inline_download': '⬇️ Скачать в боте'
     },
     'en': {
         'start': '🎵 Welcome to Music Bot!\n\n📝 Send song name to search\n🔗 Or TikTok/Instagram link to download',
@@ -66,7 +143,15 @@ TEXTS = {
         'top': '🔥 Top hits today:\n\nClick button to download:',
         'check_sub': '✅ Check subscription',
         'video_success': '✅ Video downloaded successfully!',
-        'video_error': '❌ Failed to download video. Try another link.'
+        'video_error': '❌ Failed to download video. Try another link.',
+        'queued': '⏳ You are #{} in queue, please wait...',
+        'busy': '⏳ Too many downloads right now. Try again in a minute.',
+        'throttled': '⏳ You are sending too many requests. Please wait a bit and try again.',
+        'expired': '⌛ These results have expired. Please search again.',
+        'too_large': '❌ This video is too large to send via Telegram (limit {} MB).',
+        'videos_failed': '❌ Failed to download:\n{}',
+        'unavailable': '⚠️ The service is temporarily unavailable. Try again in a couple of minutes.',
+        'inline_download': '⬇️ Download in the bot'
     },
     'uz': {
         'start': '🎵 Music Bot ga xush kelibsiz!\n\n📝 Qo\'shiq nomini yuboring\n🔗 Yoki TikTok/Instagram havolasini yuboring',
@@ -84,45 +169,296 @@ TEXTS = {
         'top': '🔥 Bugungi top qo\'shiqlar:\n\nYuklash uchun tugmani bosing:',
         'check_sub': '✅ Obunani tekshirish',
         'video_success': '✅ Video muvaffaqiyatli yuklandi!',
-        'video_error': '❌ Videoni yuklab bo\'lmadi. Boshqa havola sinab ko\'ring.'
+        'video_error': '❌ Videoni yuklab bo\'lmadi. Boshqa havola sinab ko\'ring.',
+        'queued': '⏳ Siz navbatda #{} o\'rindasiz, kuting...',
+        'busy': '⏳ Hozir yuklashlar juda ko\'p. Bir daqiqadan so\'ng urinib ko\'ring.',
+        'throttled': '⏳ Siz juda ko\'p so\'rov yubordingiz. Biroz kuting va qayta urinib ko\'ring.',
+        'expired': '⌛ Natijalar eskirgan. Qaytadan qidiring.',
+        'too_large': '❌ Video Telegram orqali yuborish uchun juda katta (limit {} MB).',
+        'videos_failed': '❌ Yuklab bo\'lmadi:\n{}',
+        'unavailable': '⚠️ Xizmat vaqtincha ishlamayapti. Bir necha daqiqadan so\'ng urinib ko\'ring.',
+        'inline_download': '⬇️ Botda yuklab olish'
     }
 }
 
-# Хранилище пользовательских настроек
-user_settings = {}
-
-def get_user_lang(user_id):
-    return user_settings.get(user_id, {}).get('lang', 'ru')
-
-def get_text(user_id, key):
-    lang = get_user_lang(user_id)
-    return TEXTS[lang][key]
-
 # Форматирование длительности
 def format_duration(seconds):
     minutes = seconds // 60
     remaining_seconds = seconds % 60
     return f"{minutes}:{remaining_seconds:02d}"
 
+# Кэш с ограничением по времени жизни и размеру (LRU)
+class TTLCache:
+    """Словарь с вытеснением давно неиспользуемых и устаревших записей"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.data[key]
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+# Объединение одновременных одинаковых задач (single-flight)
+class SingleFlight:
+    """Пока задача с ключом выполняется, повторные вызовы ждут ее результат"""
+
+    def __init__(self):
+        self.calls = {}
+        self.started = 0
+        self.saved = 0
+
+    async def run(self, key, func, *args):
+        """Возвращает (результат, shared); shared=True, если результат получен от чужого вызова"""
+        task, shared = self.start(key, func, *args)
+        return await asyncio.shield(task), shared
+
+    def start(self, key, func, *args):
+        """Регистрирует задачу сразу, без ожидания; возвращает (task, shared)"""
+        task = self.calls.get(key)
+        shared = task is not None
+        if shared:
+            self.saved += 1
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(func(*args))
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        return task, shared
+
+    async def join(self, key):
+        """Ждет результат уже идущей задачи; None, если задачи с таким ключом нет"""
+        task = self.calls.get(key)
+        if task is None:
+            return None
+        self.saved += 1
+        return await asyncio.shield(task)
+
+    def __contains__(self, key):
+        return key in self.calls
+
+    def stats(self):
+        return {'started': self.started, 'saved': self.saved, 'in_flight': len(self.calls)}
+
+# Защита от недоступных внешних сервисов (Deezer, YouTube, хостинги видео)
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+BREAKER_MAX = 100
+
+class BreakerOpenError(Exception):
+    """Сервис недавно падал подряд, запрос отклонен без обращения к нему"""
+
+class CircuitBreaker:
+    """После failures ошибок подряд отклоняет вызовы reset_timeout секунд, затем пропускает один пробный"""
+
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def __init__(self, name, failures, reset_timeout):
+        self.name = name
+        self.threshold = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        # Пробный вызов один; если он завис, через reset_timeout пускаем следующий
+        now = time.monotonic()
+        if state == 'half_open' and (self.probe_at is None or now - self.probe_at >= self.reset_timeout):
+            self.probe_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def check(self):
+        """Не занимает пробный вызов: для проверки до постановки в очередь"""
+        if self.state == 'open':
+            self.rejected += 1
+            raise BreakerOpenError(self.name)
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def failure(self):
+        self.failures += 1
+        self.probe_at = None
+        if self.opened_at is None and self.failures < self.threshold:
+            return
+        if self.state != 'open':
+            self.trips += 1
+            logger.warning(f"Circuit {self.name} opened after {self.failures} failures")
+        self.opened_at = time.monotonic()
+
+breakers = {}
+
+def get_breaker(name):
+    breaker = breakers.get(name)
+    if breaker is None:
+        breaker = breakers[name] = CircuitBreaker(name, BREAKER_FAILURES, BREAKER_RESET_TIMEOUT)
+    return breaker
+
+# Повторы и дублирующие запросы: не больше ratio от числа обычных запросов
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0.1))
+RETRY_BUDGET_RESERVE = int(os.environ.get('RETRY_BUDGET_RESERVE', 10))
+
+class RetryBudget:
+    """Каждый запрос добавляет ratio токена (не больше reserve), каждый повтор забирает один"""
+
+    def __init__(self, ratio, reserve):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+        self.retries = 0
+        self.refused = 0
+
+    def deposit(self):
+        self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.retries += 1
+            return True
+        self.refused += 1
+        return False
+
+async def hedged_request(func, delay, budget, attempts=2):
+    """Вызывает func(); если ответа нет за delay или вызов упал, запускает еще один, пока позволяет budget
+
+    Возвращает первый успешный результат, остальные вызовы отменяются.
+    """
+    budget.deposit()
+    pending = {asyncio.ensure_future(func())}
+    launched = 1
+    refused = False
+    error = None
+    try:
+        while pending:
+            # После отказа бюджета просто ждем уже запущенные вызовы
+            hedging = launched < attempts and not refused
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=delay if hedging else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if hedging:
+                if budget.withdraw():
+                    launched += 1
+                    pending.add(asyncio.ensure_future(func()))
+                else:
+                    refused = True
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+# Кэш подписок: (user_id, канал) -> подписан ли
+SUBSCRIPTION_TTL = int(os.environ.get('SUBSCRIPTION_TTL', 600))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.environ.get('SUBSCRIPTION_NEGATIVE_TTL', 60))
+SUBSCRIPTION_CACHE_SIZE = int(os.environ.get('SUBSCRIPTION_CACHE_SIZE', 50000))
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_TTL)
+
+MEMBER_STATUSES = ['member', 'administrator', 'creator']
+
+# Проверка подписки на один канал
+async def check_channel(bot, channel, user_id, force=False):
+    key = (user_id, channel)
+    if not force:
+        subscribed = subscription_cache.get(key)
+        if subscribed is not None:
+            return subscribed
+    
+    try:
+        with timed('get_chat_member'):
+            member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
+    except Exception as e:
+        ERRORS.labels('subscription').inc()
+        logger.error(f"Error checking subscription: {e}")
+        return True
+    
+    subscribed = member.status in MEMBER_STATUSES
+    subscription_cache.set(key, subscribed, None if subscribed else SUBSCRIPTION_NEGATIVE_TTL)
+    return subscribed
+
 # Проверка подписки на каналы
-async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@instrumented('check_subscription')
+async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, force=False):
     user_id = update.effective_user.id
     
-    if not REQUIRED_CHANNELS or REQUIRED_CHANNELS == ['']:
+    channels = [channel.strip() for channel in REQUIRED_CHANNELS if channel.strip()]
+    if not channels:
         return True
     
-    for channel in REQUIRED_CHANNELS:
-        if not channel.strip():
-            continue
-        try:
-            member = await context.bot.get_chat_member(chat_id=channel.strip(), user_id=user_id)
-            if member.status not in ['member', 'administrator', 'creator']:
-                return False
-        except Exception as e:
-            logger.error(f"Error checking subscription: {e}")
-            continue
+    # Каналы проверяются параллельно
+    results = await asyncio.gather(*(check_channel(context.bot, channel, user_id, force) for channel in channels))
+    return all(results)
+
+# Обновление кэша по событиям chat_member (бот должен быть админом канала)
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.chat_member
+    chat = change.chat
+    names = {str(chat.id)}
+    if chat.username:
+        names.add(f"@{chat.username.lower()}")
     
-    return True
+    user_id = change.new_chat_member.user.id
+    subscribed = change.new_chat_member.status in MEMBER_STATUSES
+    for channel in REQUIRED_CHANNELS:
+        channel = channel.strip()
+        if channel.lower() in names:
+            subscription_cache.set((user_id, channel), subscribed, None if subscribed else SUBSCRIPTION_NEGATIVE_TTL)
 
 # Проверка на наличие ссылки
 def is_video_link(text):
@@ -134,49 +470,685 @@ def is_video_link(text):
     ]
     return any(re.search(pattern, text, re.IGNORECASE) for pattern in patterns)
 
+# Ссылка в тексте; знаки препинания в конце ("(ссылка)," или "ссылка.") к ней не относятся
+URL_PATTERN = re.compile(r'https?://\S+')
+URL_TRAILING = '.,;:!?)]}>"\''
+
+def find_urls(text):
+    return [url.rstrip(URL_TRAILING) for url in URL_PATTERN.findall(text)]
+
+# Альбом в Telegram - не больше 10 файлов
+MEDIA_GROUP_LIMIT = 10
+
+def extract_video_urls(text):
+    """Все ссылки на видео из сообщения без повторов, не больше MEDIA_GROUP_LIMIT"""
+    urls = {}
+    for url in find_urls(text):
+        if is_video_link(url):
+            urls.setdefault(normalize_video_url(url), url)
+    return list(urls.values())[:MEDIA_GROUP_LIMIT]
+
+# Локальная база для кэшей (file_id и т.д.)
+CACHE_DB = os.environ.get('CACHE_DB', 'cache.db')
+
+def open_db():
+    db = sqlite3.connect(CACHE_DB, check_same_thread=False, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    return db
+
+# Хранилище пользовательских настроек
+USER_SETTINGS_CACHE_SIZE = int(os.environ.get('USER_SETTINGS_CACHE_SIZE', 10000))
+
+class UserSettings:
+    """Язык пользователя в SQLite; в памяти только недавние пользователи"""
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.cache = TTLCache(USER_SETTINGS_CACHE_SIZE, 3600)
+        with self.lock:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS user_settings ('
+                'user_id INTEGER PRIMARY KEY, lang TEXT NOT NULL)'
+            )
+
+    def get_lang(self, user_id):
+        lang = self.cache.get(user_id)
+        if lang is None:
+            with self.lock:
+                row = self.db.execute('SELECT lang FROM user_settings WHERE user_id = ?', (user_id,)).fetchone()
+            lang = row[0] if row else 'ru'
+            self.cache.set(user_id, lang)
+        return lang
+
+    def set_lang(self, user_id, lang):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO user_settings (user_id, lang) VALUES (?, ?)',
+                (user_id, lang)
+            )
+        self.cache.set(user_id, lang)
+
+user_settings = UserSettings(open_db())
+
+def get_user_lang(user_id):
+    return user_settings.get_lang(user_id)
+
+def get_text(user_id, key):
+    lang = get_user_lang(user_id)
+    return TEXTS[lang][key]
+
+# Кэш file_id: повторные треки и видео отправляются без скачивания
+class FileIdCache:
+    """Хранит file_id, которые Telegram вернул после отправки файла"""
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self.lock:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS file_ids ('
+                'key TEXT PRIMARY KEY, file_id TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT file_id FROM file_ids WHERE key = ?', (key,)).fetchone()
+        if row:
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def set(self, key, file_id):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO file_ids (key, file_id, created_at) VALUES (?, ?, ?)',
+                (key, file_id, time.time())
+            )
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM file_ids WHERE key = ?', (key,)).fetchone() is not None
+
+    def invalidate(self, key):
+        with self.lock:
+            self.db.execute('DELETE FROM file_ids WHERE key = ?', (key,))
+        logger.warning(f"File cache entry invalidated: {key}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+file_cache = FileIdCache(open_db())
+
+# Индекс Deezer трек -> YouTube видео: повторные загрузки идут без поиска
+YOUTUBE_INDEX_TTL = int(os.environ.get('YOUTUBE_INDEX_TTL', 30 * 24 * 3600))
+
+class YoutubeIndex:
+    """Хранит найденный YouTube id для Deezer трека"""
+
+    def __init__(self, db, ttl):
+        self.db = db
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self.lock:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS youtube_ids ('
+                'track_id TEXT PRIMARY KEY, video_id TEXT NOT NULL, resolved_at REAL NOT NULL)'
+            )
+
+    def get(self, track_id):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT video_id FROM youtube_ids WHERE track_id = ? AND resolved_at > ?',
+                (str(track_id), time.time() - self.ttl)
+            ).fetchone()
+        if row:
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def set(self, track_id, video_id):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO youtube_ids (track_id, video_id, resolved_at) VALUES (?, ?, ?)',
+                (str(track_id), video_id, time.time())
+            )
+
+    def invalidate(self, track_id):
+        with self.lock:
+            self.db.execute('DELETE FROM youtube_ids WHERE track_id = ?', (str(track_id),))
+        logger.warning(f"YouTube index entry invalidated: {track_id}")
+
+youtube_index = YoutubeIndex(open_db(), YOUTUBE_INDEX_TTL)
+
+# Параметры ссылок, которые не влияют на содержимое (трекинг)
+TRACKING_PARAMS = re.compile(r'^(utm_.*|igshid|igsh|_r|_t|is_from_webapp|sender_device|sender_web_id|share_.*|u_code|tt_from|checksum|timestamp|lang)$')
+
+def normalize_video_url(text):
+    """Канонический вид ссылки на видео без трекинговых параметров"""
+    urls = find_urls(text)
+    url = urls[0] if urls else text.strip()
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if host.startswith('www.') or host.startswith('m.'):
+        host = host.split('.', 1)[1]
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query) if not TRACKING_PARAMS.match(k)])
+    return urlunsplit(('https', host, parts.path.rstrip('/'), query, ''))
+
+def track_cache_key(track_id):
+    return f"track:{track_id}"
+
+def video_cache_key(url):
+    return f"video:{normalize_video_url(url)}"
+
+def video_breaker(url):
+    """Отдельный предохранитель на каждый хостинг видео"""
+    name = f"video:{urlsplit(normalize_video_url(url)).netloc}"
+    if name not in breakers and len(breakers) >= BREAKER_MAX:
+        name = 'video:other'
+    return get_breaker(name)
+
+# Пул загрузок: общий лимит одновременных процессов yt-dlp
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 3))
+DOWNLOAD_QUEUE_SIZE = int(os.environ.get('DOWNLOAD_QUEUE_SIZE', 20))
+VIDEO_TIMEOUT = int(os.environ.get('VIDEO_TIMEOUT', 60))
+MUSIC_TIMEOUT = int(os.environ.get('MUSIC_TIMEOUT', 90))
+# Лимиты на одного пользователя: загрузок в минуту, запас и длина личной очереди
+USER_DOWNLOADS_PER_MINUTE = float(os.environ.get('USER_DOWNLOADS_PER_MINUTE', 6))
+USER_DOWNLOADS_BURST = int(os.environ.get('USER_DOWNLOADS_BURST', 3))
+USER_QUEUE_SIZE = int(os.environ.get('USER_QUEUE_SIZE', 3))
+
+class QueueFullError(Exception):
+    """Очередь загрузок переполнена"""
+
+class ThrottledError(Exception):
+    """Пользователь превысил свой лимит загрузок"""
+
+class TokenBucket:
+    """Пополняется на rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class DownloadPool:
+    """Ограничивает число одновременных загрузок; свободный воркер получают пользователи по кругу"""
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        # user_id -> очередь ожидающих задач; порядок ключей задает очередность round-robin
+        self.queues = OrderedDict()
+        self.buckets = TTLCache(100000, 3600)
+        self.throttled = 0
+        self.rejected = 0
+
+    def admit(self, user_id, pending=0):
+        """Проверка перед постановкой задачи; user_id=None - служебные задачи без лимитов
+
+        pending - задачи, уже допущенные вместе с этой, но еще не поставленные в очередь.
+        """
+        if user_id is not None:
+            if len(self.queues.get(user_id, ())) + pending >= USER_QUEUE_SIZE:
+                self.throttled += 1
+                raise ThrottledError()
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = TokenBucket(USER_DOWNLOADS_PER_MINUTE / 60, USER_DOWNLOADS_BURST)
+                self.buckets.set(user_id, bucket)
+            if not bucket.take():
+                self.throttled += 1
+                raise ThrottledError()
+        if self.active >= self.workers and self.waiting + pending >= self.queue_size:
+            self.rejected += 1
+            raise QueueFullError()
+
+    def release(self):
+        # Освободившийся воркер передаем следующему пользователю по кругу
+        while self.queues:
+            user_id, queue = next(iter(self.queues.items()))
+            future = queue.popleft()
+            if queue:
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+            self.waiting -= 1
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    async def run(self, job, *args, on_queued=None, user_id=None):
+        """Выполняет job(*args), когда освободится воркер"""
+        queued_at = time.monotonic()
+        if self.active < self.workers and not self.waiting:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.queues.setdefault(user_id, deque()).append(future)
+            self.waiting += 1
+            try:
+                if on_queued:
+                    # Сообщение о месте в очереди не должно снимать задачу (например, RetryAfter)
+                    try:
+                        await on_queued(self.waiting)
+                    except Exception as e:
+                        logger.warning(f"Queue notification failed: {e!r}")
+                await future
+            except BaseException:
+                if future.done() and not future.cancelled():
+                    # Воркер уже передан этой задаче - отдаем его дальше
+                    self.release()
+                else:
+                    future.cancel()
+                    queue = self.queues.get(user_id)
+                    if queue is not None and future in queue:
+                        queue.remove(future)
+                        self.waiting -= 1
+                        if not queue:
+                            del self.queues[user_id]
+                raise
+        
+        started_at = time.monotonic()
+        STAGE_LATENCY.labels('queue_wait').observe(started_at - queued_at)
+        try:
+            return await job(*args)
+        finally:
+            self.release()
+            logger.info(
+                f"Job {job.__name__} for {user_id}: waited {started_at - queued_at:.1f}s, "
+                f"ran {time.monotonic() - started_at:.1f}s, active {self.active}, queued {self.waiting}"
+            )
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'queued': self.waiting,
+            'users_queued': len(self.queues),
+            'throttled': self.throttled,
+            'rejected': self.rejected
+        }
+
+download_pool = DownloadPool(DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_SIZE)
+
+def queue_notifier(message, user_id):
+    """Колбэк, сообщающий пользователю его место в очереди"""
+    async def notify(position):
+        await message.edit_text(get_text(user_id, 'queued').format(position))
+    return notify
+
+# Запуск yt-dlp без блокировки event loop
+async def run_ytdlp(command, timeout):
+    """Запускает yt-dlp как асинхронный подпроцесс и убивает его по таймауту"""
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        # Таймаут или отмена задачи - процесс не должен остаться висеть
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return process.returncode, stdout, stderr.decode(errors='replace')
+
+# Движок загрузок: 'pool' - прогретые процессы с yt_dlp, 'subprocess' - запуск бинарника
+YTDLP_ENGINE = os.environ.get('YTDLP_ENGINE', 'pool')
+YTDLP_BIN = os.environ.get('YTDLP_BIN', './bin/yt-dlp' if os.path.exists('./bin/yt-dlp') else 'yt-dlp')
+
+class YtdlpWorkerPool:
+    """Пул долгоживущих процессов с загруженным yt_dlp"""
+
+    def __init__(self, size):
+        self.size = size
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload(['ytdlp_worker'])
+        self.idle = None
+        self.workers = []
+
+    def spawn(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=ytdlp_worker.serve, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        self.workers.append(process)
+        return process, parent_conn
+
+    def retire(self, process, conn):
+        # Зависший или упавший воркер убиваем и заменяем новым
+        conn.close()
+        process.kill()
+        process.join(1)
+        self.workers.remove(process)
+
+    def start(self):
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for _ in range(self.size):
+                self.idle.put_nowait(self.spawn())
+
+    def stop(self):
+        for process in self.workers:
+            process.kill()
+        self.workers.clear()
+        self.idle = None
+
+    async def run(self, kind, target, outtmpl, timeout, format_spec=None):
+        self.start()
+        process, conn = await self.idle.get()
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(conn.fileno(), lambda: ready.done() or ready.set_result(None))
+        try:
+            conn.send((kind, target, outtmpl, format_spec))
+            await asyncio.wait_for(ready, timeout)
+            loop.remove_reader(conn.fileno())
+            result = conn.recv()
+        except BaseException:
+            loop.remove_reader(conn.fileno())
+            self.retire(process, conn)
+            self.idle.put_nowait(self.spawn())
+            raise
+        self.idle.put_nowait((process, conn))
+        return result
+
+ytdlp_pool = YtdlpWorkerPool(DOWNLOAD_WORKERS)
+
+def children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+# Повторы загрузок после сетевых сбоев
+download_retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_RESERVE)
+
+async def run_download(kind, target, outtmpl, timeout, format_spec=None):
+    """Скачивает target выбранным движком; возвращает (вид ошибки или None, сообщение, CPU в секундах)"""
+    download_retry_budget.deposit()
+    error, message, cpu = await attempt_download(kind, target, outtmpl, timeout, format_spec)
+    # Сетевой сбой повторяем один раз, если позволяет бюджет повторов
+    if error == 'network' and download_retry_budget.withdraw():
+        logger.warning(f"Retrying yt-dlp after network error: {message}")
+        error, message, retry_cpu = await attempt_download(kind, target, outtmpl, timeout, format_spec)
+        cpu += retry_cpu
+    return error, message, cpu
+
+async def attempt_download(kind, target, outtmpl, timeout, format_spec):
+    started = time.perf_counter()
+    postprocess = None
+    try:
+        if YTDLP_ENGINE == 'subprocess':
+            # Время дочерних процессов: при параллельных загрузках значение приблизительное
+            cpu_start = children_cpu_seconds()
+            command = [YTDLP_BIN, *ytdlp_worker.CLI_ARGS[kind], '-o', outtmpl, target]
+            if format_spec:
+                command[-1:-1] = ['-f', format_spec]
+            returncode, _, stderr = await run_ytdlp(command, timeout)
+            cpu = children_cpu_seconds() - cpu_start
+            error, message = (None, '') if returncode == 0 else (ytdlp_worker.classify_error(stderr), stderr)
+        else:
+            status, message, cpu, postprocess = await ytdlp_pool.run(kind, target, outtmpl, timeout, format_spec)
+            error = None if status == 'ok' else status
+    except asyncio.TimeoutError:
+        ERRORS.labels('ytdlp_timeout').inc()
+        raise
+    
+    # Постобработку (ffmpeg) воркер меряет отдельно
+    elapsed = time.perf_counter() - started
+    if postprocess is not None:
+        STAGE_LATENCY.labels('transcode').observe(postprocess)
+        elapsed -= postprocess
+    STAGE_LATENCY.labels('ytdlp_fetch').observe(elapsed)
+    if error:
+        ERRORS.labels(f'ytdlp_{error}').inc()
+    return error, message, cpu
+
+def record_ytdlp_result(breaker, error):
+    """Неудачная загрузка: сбоем сервиса считаются только сеть, таймауты и неизвестные ошибки"""
+    if error in ('network', 'timeout', 'error', None):
+        breaker.failure()
+    else:
+        # Видео удалено или не поддерживается - сам сервис отвечает
+        breaker.success()
+
+# Лимит суммарного размера файлов, ожидающих отправки
+MEDIA_INFLIGHT_BYTES = int(os.environ.get('MEDIA_INFLIGHT_BYTES', 200 * 1024 * 1024))
+
+class MediaBudget:
+    """Ограничивает суммарный размер одновременно отправляемых файлов"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        async with self.condition:
+            # Файл больше лимита пропускаем, только когда больше ничего не отправляется
+            await self.condition.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    async def release(self, size):
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+media_budget = MediaBudget(MEDIA_INFLIGHT_BYTES)
+
+# Скачанный файл на диске: отправляется потоком и удаляется после отправки
+class MediaFile:
+    """Файл во временной папке; async with резервирует лимит и убирает за собой"""
+
+    def __init__(self, temp_dir, path, duration=None):
+        self.temp_dir = temp_dir
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.duration = duration
+        self.handle = None
+
+    @property
+    def ext(self):
+        return os.path.splitext(self.path)[1]
+
+    @property
+    def video_id(self):
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    def input_file(self, filename=None, attach=False):
+        """Файл для Telegram, который читается с диска во время загрузки
+
+        attach=True нужен для InputMedia* в send_media_group.
+        """
+        self.handle = open(self.path, 'rb')
+        return InputFile(self.handle, filename=filename, attach=attach, read_file_handle=False)
+
+    def cleanup(self):
+        if self.handle:
+            self.handle.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    async def __aenter__(self):
+        try:
+            await media_budget.acquire(self.size)
+        except BaseException:
+            self.cleanup()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.cleanup()
+        await media_budget.release(self.size)
+
+# Предварительная проверка метаданных видео
+UPLOAD_LIMIT = int(os.environ.get('UPLOAD_LIMIT', 50 * 1024 * 1024))
+PROBE_TIMEOUT = int(os.environ.get('PROBE_TIMEOUT', 20))
+PROBE_CACHE_TTL = int(os.environ.get('PROBE_CACHE_TTL', 600))
+probe_cache = TTLCache(2000, PROBE_CACHE_TTL)
+probe_flights = SingleFlight()
+
+class TooLargeError(Exception):
+    """Ни один формат видео не помещается в лимит загрузки Telegram"""
+
+async def probe_video(url):
+    """Метаданные видео (длительность и форматы) или None, если yt-dlp не смог их получить"""
+    key = normalize_video_url(url)
+    info = probe_cache.get(key)
+    if info is None:
+        info, _ = await probe_flights.run(key, fetch_probe, key, url)
+    return info
+
+async def fetch_probe(key, url):
+    try:
+        with timed('probe_video'):
+            if YTDLP_ENGINE == 'subprocess':
+                command = [YTDLP_BIN, *ytdlp_worker.CLI_ARGS['probe'], url]
+                returncode, stdout, stderr = await run_ytdlp(command, PROBE_TIMEOUT)
+                if returncode != 0:
+                    logger.error(f"yt-dlp probe {ytdlp_worker.classify_error(stderr)}: {stderr}")
+                    return None
+                info = ytdlp_worker.compact_probe(json.loads(stdout))
+            else:
+                status, info, _, _ = await ytdlp_pool.run('probe', url, None, PROBE_TIMEOUT)
+                if status != 'ok':
+                    logger.error(f"yt-dlp probe {status}: {info}")
+                    return None
+    except Exception as e:
+        ERRORS.labels('probe').inc()
+        logger.error(f"Probe error: {e!r}")
+        return None
+    
+    probe_cache.set(key, info)
+    return info
+
+def estimated_size(fmt, duration):
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return size
+
+def choose_video_format(info, limit):
+    """Лучший формат, который помещается в limit; None - ни один не помещается"""
+    duration = info.get('duration')
+    if not info['formats']:
+        # Форматов нет (например, карусель Instagram) - пусть yt-dlp выберет сам
+        return f"best[filesize<?{limit}]"
+    
+    # Аудиодорожки для склейки с видео без звука: (битрейт, размер, id)
+    audios = []
+    for fmt in info['formats']:
+        if fmt.get('vcodec') == 'none' and fmt.get('acodec') != 'none':
+            size = estimated_size(fmt, duration)
+            if size:
+                audios.append((fmt.get('tbr') or 0, size, fmt['format_id']))
+    
+    candidates = []
+    unknown = False
+    for fmt in info['formats']:
+        if fmt.get('vcodec') == 'none':
+            continue
+        size = estimated_size(fmt, duration)
+        if not size:
+            unknown = True
+            continue
+        if size > limit:
+            continue
+        if fmt.get('acodec') != 'none':
+            candidates.append((True, fmt.get('height') or 0, fmt.get('tbr') or 0, fmt['format_id']))
+            continue
+        # Видео без звука: размер считаем вместе с лучшей дорожкой, которая влезает в остаток
+        remaining = limit - size
+        if audios:
+            fitting = [audio for audio in audios if audio[1] <= remaining]
+            if not fitting:
+                continue
+            audio_spec = max(fitting)[2]
+        else:
+            audio_spec = f"bestaudio[filesize<?{remaining}]"
+        # Если склейка не удалась, лучше целый ролик со звуком, чем видео без звука
+        spec = f"{fmt['format_id']}+{audio_spec}/best[filesize<?{limit}]"
+        candidates.append((False, fmt.get('height') or 0, fmt.get('tbr') or 0, spec))
+    
+    if not candidates:
+        # Размеры неизвестны - пусть yt-dlp отфильтрует сам
+        return f"best[filesize<?{limit}]" if unknown else None
+    
+    return max(candidates)[3]
+
 # Скачивание видео через yt-dlp
 async def download_video(url):
     """Скачивание видео с TikTok/Instagram через yt-dlp"""
+    # Хостинг недавно не отвечал - не тратим на него таймаут
+    breaker = video_breaker(url)
+    if not breaker.allow():
+        raise BreakerOpenError(breaker.name)
+    
+    # Формат выбираем заранее, чтобы не качать файл, который Telegram не примет
+    info = await probe_video(url)
+    format_spec = choose_video_format(info, UPLOAD_LIMIT) if info else f"best[filesize<?{UPLOAD_LIMIT}]"
+    if format_spec is None:
+        breaker.success()
+        raise TooLargeError()
+    
+    temp_dir = tempfile.mkdtemp()
+    error = 'error'
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            output_path = os.path.join(temp_dir, 'video.mp4')
-            
-            # Команда yt-dlp для скачивания без водяного знака
-            command = [
-                'yt-dlp',
-                '-f', 'best',
-                '--no-warnings',
-                '--quiet',
-                '-o', output_path,
-                url
-            ]
-            
-            # Запускаем команду
-            result = subprocess.run(command, capture_output=True, timeout=60)
-            
-            if result.returncode == 0 and os.path.exists(output_path):
-                # Читаем файл
-                with open(output_path, 'rb') as f:
-                    video_data = f.read()
-                return video_data
-            else:
-                logger.error(f"yt-dlp error: {result.stderr.decode()}")
-                return None
-                
-    except subprocess.TimeoutExpired:
+        output_path = os.path.join(temp_dir, 'video.mp4')
+        
+        # Скачиваем без водяного знака
+        error, message, cpu = await run_download('video', url, output_path, VIDEO_TIMEOUT, format_spec)
+        
+        if error is None and os.path.exists(output_path):
+            breaker.success()
+            # Файл остается на диске до отправки
+            video_file = MediaFile(temp_dir, output_path)
+            BYTES_DOWNLOADED.labels('video').inc(video_file.size)
+            logger.info(f"Video downloaded: format {format_spec}, {video_file.size} bytes, cpu {cpu:.2f}s")
+            return video_file
+        else:
+            logger.error(f"yt-dlp {error or 'error'}: {message}")
+    except asyncio.TimeoutError:
+        error = 'timeout'
         logger.error("yt-dlp timeout")
-        return None
     except Exception as e:
+        ERRORS.labels('download').inc()
         logger.error(f"Download video error: {e}")
-        return None
+    
+    record_ytdlp_result(breaker, error)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return None
 
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if user_id not in user_settings:
-        user_settings[user_id] = {'lang': 'ru'}
-    
     if not await check_subscription(update, context):
         keyboard = [[InlineKeyboardButton(get_text(user_id, 'check_sub'), callback_data='check_sub')]]
         text = get_text(user_id, 'subscribe')
@@ -186,6 +1158,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
         return
     
+    # Переход из inline-режима: трек, которого еще нет в Telegram
+    if context.args and context.args[0].startswith('track_'):
+        track = inline_tracks.get(context.args[0][len('track_'):])
+        if track:
+            sessions.set((user_id, 'search'), (track,))
+            text = (
+                get_text(user_id, 'found').format(1) + '\n\n'
+                f"1. {track.artist} - {track.title} ({format_duration(track.duration)})\n\n"
+                + get_text(user_id, 'select')
+            )
+            await update.message.reply_text(text, reply_markup=build_track_keyboard(1, 'download'))
+            return
+    
     await update.message.reply_text(get_text(user_id, 'start'))
 
 # Команда /settings
@@ -203,7 +1188,94 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+# Топ хиты - поиск через API
+TOP_QUERIES = [
+    "INSTASAMKA За деньги да",
+    "Miyagi Kosandra",
+    "Скриптонит Положение",
+    "Элджей Розовое вино",
+    "Моргенштерн Cadillac",
+    "JONY Комета",
+    "Баста Сансара",
+    "Zivert Life",
+    "HammAli Navai Прятки",
+    "T-Fest Улети"
+]
+TOP_REFRESH_INTERVAL = int(os.environ.get('TOP_REFRESH_INTERVAL', 3600))
+# Чат (например, закрытый канал), куда бот заранее загружает треки топа
+CACHE_CHAT_ID = os.environ.get('CACHE_CHAT_ID', '')
+
+# Готовый топ: треки, строки списка и клавиатура
+top_state = {'tracks': [], 'lines': '', 'markup': None, 'updated_at': 0}
+top_lock = asyncio.Lock()
+
+# Клавиатура с номерами треков
+def build_track_keyboard(count, prefix):
+    keyboard = []
+    row = []
+    for i in range(1, min(count + 1, 11)):
+        emoji_number = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟'][i-1]
+        row.append(InlineKeyboardButton(emoji_number, callback_data=f'{prefix}_{i-1}'))
+        
+        if len(row) == 3:
+            keyboard.append(row)
+            row = []
+    
+    if row:
+        keyboard.append(row)
+    
+    return InlineKeyboardMarkup(keyboard)
+
+# Обновление топа (параллельный поиск всех треков)
+async def refresh_top(bot=None):
+    async with top_lock:
+        with timed('top_refresh'):
+            results = await asyncio.gather(*(search_music(query, limit=1) for query in TOP_QUERIES))
+        top_results = tuple(found[0] for found in results if found)
+        
+        if not top_results:
+            logger.error("Top hits refresh returned no tracks")
+            return
+        
+        lines = ''
+        for idx, track in enumerate(top_results, 1):
+            duration_formatted = format_duration(track.duration)
+            lines += f"{idx}. {track.artist} - {track.title} ({duration_formatted})\n"
+        
+        top_state.update(
+            tracks=top_results,
+            lines=lines,
+            markup=build_track_keyboard(len(top_results), 'top'),
+            updated_at=time.time()
+        )
+        logger.info(f"Top hits refreshed: {len(top_results)} tracks")
+    
+    if bot is not None and CACHE_CHAT_ID:
+        await prewarm_tracks(bot, top_results)
+
+# Заранее скачиваем треки топа, чтобы кнопки отвечали по file_id
+async def prewarm_tracks(bot, tracks):
+    for track in tracks:
+        track_key = track_cache_key(track.id)
+        if track_key in file_cache:
+            continue
+        try:
+            download_pool.admit(None)
+            await download_flights.run(track_key, fetch_and_send_audio, bot, CACHE_CHAT_ID, track, None, None)
+        except QueueFullError:
+            logger.info("Top prewarm postponed: download queue is full")
+            return
+        except BreakerOpenError:
+            logger.info("Top prewarm postponed: YouTube circuit is open")
+            return
+        except TelegramError as e:
+            logger.error(f"Top prewarm upload failed: {e}")
+
+async def refresh_top_job(context: ContextTypes.DEFAULT_TYPE):
+    await refresh_top(context.bot)
+
 # Команда /top с возможностью скачать
+@instrumented('top_hits')
 async def top_hits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -212,103 +1284,630 @@ async def top_hits(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(get_text(user_id, 'subscribe'), reply_markup=InlineKeyboardMarkup(keyboard))
         return
     
-    # Топ хиты - поиск через API
-    top_queries = [
-        "INSTASAMKA За деньги да",
-        "Miyagi Kosandra",
-        "Скриптонит Положение",
-        "Элджей Розовое вино",
-        "Моргенштерн Cadillac",
-        "JONY Комета",
-        "Баста Сансара",
-        "Zivert Life",
-        "HammAli Navai Прятки",
-        "T-Fest Улети"
-    ]
-    
-    # Ищем каждый трек
-    status_msg = await update.message.reply_text('🔍 Загружаю топ хиты...')
-    
-    top_results = []
-    for query in top_queries:
-        results = await search_music(query, limit=1)
-        if results:
-            top_results.append(results[0])
-    
-    if not top_results:
-        await status_msg.edit_text('❌ Не удалось загрузить топ хиты')
-        return
+    # Топ еще не готов (первый запуск) - загружаем сейчас
+    if not top_state['tracks']:
+        status_msg = await update.message.reply_text('🔍 Загружаю топ хиты...')
+        await refresh_top()
+        if not top_state['tracks']:
+            await status_msg.edit_text('❌ Не удалось загрузить топ хиты')
+            return
+        await status_msg.delete()
     
     # Сохраняем результаты
-    context.user_data['top_results'] = top_results
-    
-    # Формируем сообщение
-    text = get_text(user_id, 'top') + '\n\n'
-    
-    for idx, track in enumerate(top_results, 1):
-        artist = track.get('artist', {}).get('name', 'Unknown')
-        title = track.get('title', 'Unknown')
-        duration_sec = track.get('duration', 0)
-        duration_formatted = format_duration(duration_sec)
-        text += f"{idx}. {artist} - {title} ({duration_formatted})\n"
-    
-    # Создаем клавиатуру
-    keyboard = []
-    row = []
-    for i in range(1, min(len(top_results) + 1, 11)):
-        emoji_number = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟'][i-1]
-        row.append(InlineKeyboardButton(emoji_number, callback_data=f'top_{i-1}'))
-        
-        if len(row) == 3:
-            keyboard.append(row)
-            row = []
+    sessions.set((user_id, 'top'), top_state['tracks'])
     
-    if row:
-        keyboard.append(row)
-    
-    await status_msg.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    text = get_text(user_id, 'top') + '\n\n' + top_state['lines']
+    await update.message.reply_text(text, reply_markup=top_state['markup'])
+
+# Общий HTTP клиент с пулом keep-alive соединений
+DEEZER_API = os.environ.get('DEEZER_API', 'https://api.deezer.com')
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 10))
+http_client = None
+
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+        )
+    return http_client
+
+# Компактная запись о треке: только то, что нужно боту
+class TrackRecord:
+    __slots__ = ('id', 'artist', 'title', 'duration', 'link')
+
+    def __init__(self, id, artist, title, duration, link):
+        self.id = id
+        self.artist = artist
+        self.title = title
+        self.duration = duration
+        self.link = link
+
+    @classmethod
+    def from_deezer(cls, track):
+        return cls(
+            track.get('id'),
+            track.get('artist', {}).get('name', 'Unknown'),
+            track.get('title', 'Unknown'),
+            track.get('duration', 0),
+            track.get('link')
+        )
+
+# Результаты поиска и топа для кнопок: ограничены по числу пользователей и возрасту
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 3600))
+SESSION_MAX_USERS = int(os.environ.get('SESSION_MAX_USERS', 20000))
+sessions = TTLCache(SESSION_MAX_USERS, SESSION_TTL)
+
+# Кэш результатов поиска
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 600))
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 1000))
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+search_flights = SingleFlight()
+
+# Медленный ответ Deezer дублируем вторым запросом, ошибку повторяем
+DEEZER_HEDGE_DELAY = float(os.environ.get('DEEZER_HEDGE_DELAY', 1.0))
+search_retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_RESERVE)
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+# Локальный каталог треков из прошлых ответов Deezer с триграммным индексом
+CATALOG_TTL = int(os.environ.get('CATALOG_TTL', 30 * 24 * 3600))
+CATALOG_FLUSH_INTERVAL = int(os.environ.get('CATALOG_FLUSH_INTERVAL', 10))
+CATALOG_EXPIRE_INTERVAL = int(os.environ.get('CATALOG_EXPIRE_INTERVAL', 3600))
+# Доля триграмм запроса, найденных в треке: уверенный ответ и запасной при сбое Deezer
+CATALOG_CONFIDENCE = float(os.environ.get('CATALOG_CONFIDENCE', 0.9))
+CATALOG_FALLBACK_SCORE = float(os.environ.get('CATALOG_FALLBACK_SCORE', 0.5))
+# Доля триграмм трека, покрытых запросом: короткий запрос "love" не равен "love story"
+CATALOG_COVERAGE = float(os.environ.get('CATALOG_COVERAGE', 0.6))
+# Сколько уверенных совпадений нужно, чтобы не спрашивать Deezer
+CATALOG_MIN_RESULTS = int(os.environ.get('CATALOG_MIN_RESULTS', 5))
+CATALOG_CANDIDATES = 200
+CATALOG_PENDING_MAX = 1000
+
+def catalog_text(text):
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+def trigrams(text, prefix=False):
+    """Триграммы слов с отступом слева: начало слова дает поиск по префиксу
+
+    prefix=True - последнее слово запроса может быть недописанным.
+    """
+    grams = set()
+    words = text.split()
+    for idx, word in enumerate(words):
+        padded = f"  {word}" if prefix and idx == len(words) - 1 else f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class TrackCatalog:
+    """Треки в SQLite; новые записи копятся в памяти и индексируются фоновой задачей"""
+
+    def __init__(self, db, ttl):
+        self.db = db
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.size = 0
+        self.answered = 0
+        self.fallbacks = 0
+        with self.lock:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS catalog_tracks ('
+                'track_id TEXT PRIMARY KEY, artist TEXT NOT NULL, title TEXT NOT NULL, '
+                'duration INTEGER NOT NULL, link TEXT, grams INTEGER NOT NULL, seen_at REAL NOT NULL)'
+            )
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS catalog_trigrams ('
+                'gram TEXT NOT NULL, track_id TEXT NOT NULL, PRIMARY KEY (gram, track_id)) WITHOUT ROWID'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS catalog_trigrams_track ON catalog_trigrams (track_id)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS catalog_tracks_seen ON catalog_tracks (seen_at)')
+            self.size = self.db.execute('SELECT COUNT(*) FROM catalog_tracks').fetchone()[0]
+
+    def add(self, tracks):
+        for track in tracks:
+            if track.id is not None:
+                self.pending[str(track.id)] = track
+        # Без фоновой задачи (нет JobQueue) пишем, когда накопилось много
+        if len(self.pending) >= CATALOG_PENDING_MAX:
+            asyncio.ensure_future(self.flush_async())
+
+    def take_pending(self):
+        pending, self.pending = self.pending, {}
+        return pending
+
+    async def flush_async(self):
+        """Записывает накопленные треки в отдельном потоке, не занимая event loop"""
+        pending = self.take_pending()
+        try:
+            return await asyncio.to_thread(self.write, pending)
+        except BaseException:
+            # Не записанное вернется со следующей порцией
+            self.pending = {**pending, **self.pending}
+            raise
+
+    def write(self, pending):
+        """Одна транзакция: известным трекам обновляет seen_at, новые добавляет в индекс"""
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                inserted = 0
+                for track_id, track in pending.items():
+                    grams = trigrams(catalog_text(f"{track.artist} {track.title}"))
+                    known = self.db.execute(
+                        'UPDATE catalog_tracks SET seen_at = ? WHERE track_id = ?', (now, track_id)
+                    ).rowcount
+                    if known:
+                        continue
+                    self.db.execute(
+                        'INSERT INTO catalog_tracks (track_id, artist, title, duration, link, grams, seen_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (track_id, track.artist, track.title, track.duration, track.link, len(grams), now)
+                    )
+                    self.db.executemany(
+                        'INSERT OR IGNORE INTO catalog_trigrams (gram, track_id) VALUES (?, ?)',
+                        [(gram, track_id) for gram in grams]
+                    )
+                    inserted += 1
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.size += inserted
+        return len(pending)
+
+    def expire(self):
+        """Удаляет треки, которые не встречались дольше ttl; возвращает их число"""
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                expired = [row[0] for row in self.db.execute(
+                    'SELECT track_id FROM catalog_tracks WHERE seen_at < ?', (time.time() - self.ttl,)
+                )]
+                for track_id in expired:
+                    self.db.execute('DELETE FROM catalog_trigrams WHERE track_id = ?', (track_id,))
+                    self.db.execute('DELETE FROM catalog_tracks WHERE track_id = ?', (track_id,))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.size -= len(expired)
+        return len(expired)
+
+    def search(self, query, limit=10):
+        """Похожие треки: список (score, coverage, TrackRecord) по убыванию score
+
+        score - доля триграмм запроса в треке, coverage - доля триграмм трека в запросе.
+        """
+        query_grams = trigrams(catalog_text(query), prefix=True)
+        if not query_grams:
+            return []
+        placeholders = ','.join('?' * len(query_grams))
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT t.track_id, t.artist, t.title, t.duration, t.link, t.grams, m.shared FROM ('
+                f'  SELECT track_id, COUNT(*) AS shared FROM catalog_trigrams WHERE gram IN ({placeholders})'
+                '   GROUP BY track_id ORDER BY shared DESC LIMIT ?'
+                ') AS m JOIN catalog_tracks AS t ON t.track_id = m.track_id',
+                (*query_grams, CATALOG_CANDIDATES)
+            ).fetchall()
+        scored = []
+        for track_id, artist, title, duration, link, grams, shared in rows:
+            # Главное - покрытие запроса; при равенстве выше трек без лишних слов
+            score = shared / len(query_grams)
+            scored.append((score, shared / grams, TrackRecord(track_id, artist, title, duration, link)))
+        scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+        return scored[:limit]
+
+    def stats(self):
+        return {'size': self.size, 'pending': len(self.pending), 'answered': self.answered, 'fallbacks': self.fallbacks}
+
+track_catalog = TrackCatalog(open_db(), CATALOG_TTL)
+
+async def find_tracks(query):
+    """Поиск для сообщений: уверенный ответ каталога сразу, иначе Deezer, при пустом ответе - похожие из каталога"""
+    # Запрос к SQLite не блокирует event loop
+    with timed('catalog_search'):
+        local = await asyncio.to_thread(track_catalog.search, query)
+    # Уверенный ответ - трек совпадает с запросом целиком, а не только содержит его слова
+    confident = [
+        track for score, coverage, track in local
+        if score >= CATALOG_CONFIDENCE and coverage >= CATALOG_COVERAGE
+    ]
+    if len(confident) >= CATALOG_MIN_RESULTS:
+        track_catalog.answered += 1
+        return tuple(confident)
+
+    results = await search_music(query)
+    if results:
+        return results
+
+    # Deezer недоступен или не понял опечатку
+    fallback = tuple(track for score, _, track in local if score >= CATALOG_FALLBACK_SCORE)
+    if fallback:
+        track_catalog.fallbacks += 1
+    return fallback
+
+async def flush_catalog_job(context: ContextTypes.DEFAULT_TYPE):
+    if not track_catalog.pending:
+        return
+    seen = await track_catalog.flush_async()
+    logger.info(f"Track catalog updated: {seen} seen, {track_catalog.size} total")
+
+async def expire_catalog_job(context: ContextTypes.DEFAULT_TYPE):
+    expired = await asyncio.to_thread(track_catalog.expire)
+    if expired:
+        logger.info(f"Track catalog expired: {expired} removed, {track_catalog.size} total")
 
 # Поиск музыки через API
 async def search_music(query, limit=10):
     """Поиск музыки через Deezer API (бесплатный)"""
-    try:
-        url = f"https://api.deezer.com/search?q={query}&limit={limit}"
-        response = requests.get(url, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            return data.get('data', [])
+    key = (normalize_query(query), limit)
+    results = search_cache.get(key)
+    if results is not None:
+        return results
+    
+    # Одинаковые запросы в полете ждут один и тот же HTTP запрос
+    results, _ = await search_flights.run(key, fetch_search, key[0], limit)
+    return results
+
+async def fetch_search(query, limit):
+    # Deezer недавно не отвечал - сразу пустой результат вместо ожидания таймаута
+    breaker = get_breaker('deezer')
+    if not breaker.allow():
         return []
+    
+    try:
+        with timed('deezer_request'):
+            payload = await hedged_request(
+                functools.partial(request_deezer, query, limit),
+                DEEZER_HEDGE_DELAY, search_retry_budget
+            )
     except Exception as e:
-        logger.error(f"Search error: {e}")
+        breaker.failure()
+        ERRORS.labels('deezer').inc()
+        logger.error(f"Search error: {e!r}")
         return []
+    
+    breaker.success()
+    if payload is None:
+        ERRORS.labels('deezer_status').inc()
+        return []
+    results = tuple(TrackRecord.from_deezer(track) for track in payload.get('data', []))
+    search_cache.set((query, limit), results)
+    track_catalog.add(results)
+    return results
+
+async def request_deezer(query, limit):
+    """Ответ Deezer /search; None при ошибке запроса, исключение при сбое сервиса"""
+    response = await get_http_client().get(
+        f"{DEEZER_API}/search",
+        params={'q': query, 'limit': limit}
+    )
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+    if response.status_code != 200:
+        return None
+    payload = response.json()
+    # Превышение квоты Deezer возвращает с кодом 200
+    if 'error' in payload:
+        raise RuntimeError(f"Deezer error: {payload['error']}")
+    return payload
+
+# Режим аудио: 'native' - M4A/AAC (дорожка AAC без перекодирования), 'mp3' - перекодирование в MP3
+AUDIO_MODE = os.environ.get('AUDIO_MODE', 'native')
+
+# Длительность файла по данным ffprobe
+async def probe_duration(path):
+    try:
+        with timed('probe'):
+            return await run_ffprobe(path)
+    except Exception as e:
+        logger.error(f"ffprobe error: {e}")
+        return None
+
+async def run_ffprobe(path):
+    process = await asyncio.create_subprocess_exec(
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'format=duration',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await asyncio.wait_for(process.communicate(), 10)
+    return round(float(stdout.decode().strip()))
 
 # Скачивание музыки
-async def download_music(query_text):
+async def download_music(query_text, track_id=None):
     """Скачивание полной версии через YouTube (yt-dlp)"""
+    if not get_breaker('youtube').allow():
+        raise BreakerOpenError('youtube')
+    
+    video_id = youtube_index.get(track_id) if track_id else None
+    if video_id:
+        audio_file, error = await fetch_audio(f"https://www.youtube.com/watch?v={video_id}", track_id)
+        if audio_file or error not in ('unavailable', 'unsupported'):
+            return audio_file
+        # Сохраненное видео пропало - ищем заново
+        youtube_index.invalidate(track_id)
+    
+    # Ищем на YouTube и качаем только аудио
+    audio_file, _ = await fetch_audio(f"ytsearch1:{query_text}", track_id)
+    if audio_file and track_id:
+        youtube_index.set(track_id, audio_file.video_id)
+    return audio_file
+
+async def fetch_audio(target, track_id):
+    """Возвращает (MediaFile или None, вид ошибки)"""
+    temp_dir = tempfile.mkdtemp()
+    error = 'error'
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            output_path = os.path.join(temp_dir, 'audio.mp3')
-            # Ищем на YouTube и качаем только аудио
-            command = [
-                './bin/yt-dlp',
-                '--extract-audio',
-                '--audio-format', 'mp3',
-                '--noplaylist',
-                '--limit-rate', '5M',
-                '-o', output_path,
-                f"ytsearch1:{query_text}"
-            ]
-            result = subprocess.run(command, capture_output=True, timeout=90)
-            if result.returncode == 0 and os.path.exists(output_path):
-                with open(output_path, 'rb') as f:
-                    return f.read()
-        return None
+        # Имя файла - YouTube id, чтобы запомнить найденное видео
+        error, message, cpu = await run_download(
+            AUDIO_MODE, target,
+            os.path.join(temp_dir, '%(id)s.%(ext)s'), MUSIC_TIMEOUT
+        )
+        outputs = [path for path in glob.glob(os.path.join(temp_dir, '*')) if not path.endswith('.part')]
+        if error is None and outputs:
+            audio_file = MediaFile(temp_dir, outputs[0], await probe_duration(outputs[0]))
+            BYTES_DOWNLOADED.labels('audio').inc(audio_file.size)
+            logger.info(
+                f"Track {track_id} downloaded in {AUDIO_MODE} mode: {audio_file.ext}, "
+                f"{audio_file.size} bytes, cpu {cpu:.2f}s"
+            )
+            get_breaker('youtube').success()
+            return audio_file, None
+        logger.error(f"yt-dlp {error or 'error'} for track {track_id}: {message}")
+    except asyncio.TimeoutError:
+        error = 'timeout'
+        logger.error(f"yt-dlp timeout for track {track_id}")
     except Exception as e:
+        ERRORS.labels('download').inc()
         logger.error(f"Full music download error: {e}")
+    
+    record_ytdlp_result(get_breaker('youtube'), error)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return None, error or 'error'
+
+# Одинаковые загрузки (трек или ссылка) в полете выполняются один раз
+download_flights = SingleFlight()
+
+async def fetch_and_send_audio(bot, chat_id, track, on_queued, user_id):
+    """Скачивает трек, отправляет его в chat_id и возвращает file_id"""
+    track_id = track.id
+    artist = track.artist
+    title = track.title
+    
+    audio_file = await download_pool.run(
+        download_music, f"{artist} - {title}", track_id,
+        on_queued=on_queued, user_id=user_id
+    )
+    if not audio_file:
+        return None
+    
+    # Отправляем аудио потоком с диска
+    async with audio_file:
+        with timed('upload'):
+            sent = await bot.send_audio(
+                chat_id=chat_id,
+                audio=audio_file.input_file(f"{artist} - {title}{audio_file.ext}"),
+                title=title,
+                performer=artist,
+                duration=audio_file.duration or track.duration
+            )
+        BYTES_UPLOADED.labels('audio').inc(audio_file.size)
+    if not sent.audio:
+        return None
+    file_cache.set(track_cache_key(track_id), sent.audio.file_id)
+    return sent.audio.file_id
+
+async def fetch_and_send_video(bot, chat_id, url, caption, on_queued, user_id):
+    """Скачивает видео, отправляет его в chat_id и возвращает file_id"""
+    video_file = await download_pool.run(download_video, url, on_queued=on_queued, user_id=user_id)
+    if not video_file:
         return None
+    
+    async with video_file:
+        with timed('upload'):
+            sent = await bot.send_video(
+                chat_id=chat_id,
+                video=video_file.input_file(),
+                supports_streaming=True,
+                caption=caption
+            )
+        BYTES_UPLOADED.labels('video').inc(video_file.size)
+    media = sent.video or sent.document
+    if not media:
+        return None
+    file_cache.set(video_cache_key(url), media.file_id)
+    return media.file_id
+
+async def group_video_job(url, user_id, downloaded, uploaded):
+    """Загрузка для альбома под общим ключом download_flights
+
+    Скачанный файл отдается через downloaded, а результатом полета становится
+    file_id из uploaded - его получат и те, кто присоединился к полету.
+    """
+    try:
+        video_file = await download_pool.run(download_video, url, user_id=user_id)
+    except asyncio.CancelledError:
+        downloaded.cancel()
+        raise
+    except Exception as e:
+        # Ошибку получит владелец через downloaded, присоединившиеся - None
+        downloaded.set_exception(e)
+        return None
+    downloaded.set_result(video_file)
+    if not video_file:
+        return None
+    return await uploaded
+
+async def fetch_group_video(url, user_id, uploaded):
+    """Одно видео для альбома: (file_id, None) из кэша или (None, MediaFile) с диска"""
+    video_key = video_cache_key(url)
+    file_id = file_cache.get(video_key)
+    if file_id:
+        return file_id, None
+
+    # То же видео уже качается для другого пользователя - ждем его file_id
+    if video_key in download_flights:
+        return await download_flights.join(video_key), None
+
+    video_breaker(url).check()
+    downloaded = asyncio.get_running_loop().create_future()
+    # Ключ регистрируется синхронно: полет, начатый в этом же такте, не разминется с нашим
+    task, shared = download_flights.start(video_key, group_video_job, url, user_id, downloaded, uploaded)
+    if shared:
+        return await asyncio.shield(task), None
+    return None, await downloaded
+
+async def send_video_group(bot, chat_id, items, caption):
+    """Отправляет готовые видео одним альбомом; items - список (url, file_id, MediaFile)
+
+    Возвращает file_id отправленных видео по ссылкам.
+    """
+    files = [video_file for _, _, video_file in items if video_file]
+    total = sum(video_file.size for video_file in files)
+
+    # Резервируем лимит сразу на весь альбом, а не по одному файлу
+    await media_budget.acquire(total)
+    try:
+        with timed('upload'):
+            if len(items) == 1:
+                _, file_id, video_file = items[0]
+                sent = [await bot.send_video(
+                    chat_id=chat_id,
+                    video=file_id or video_file.input_file(),
+                    supports_streaming=True,
+                    caption=caption
+                )]
+            else:
+                media = [
+                    InputMediaVideo(
+                        media=file_id or video_file.input_file(attach=True),
+                        caption=caption if idx == 0 else None,
+                        supports_streaming=True
+                    )
+                    for idx, (_, file_id, video_file) in enumerate(items)
+                ]
+                sent = await bot.send_media_group(chat_id=chat_id, media=media)
+    finally:
+        for video_file in files:
+            video_file.cleanup()
+        await media_budget.release(total)
+
+    file_ids = {}
+    for (url, _, video_file), message in zip(items, sent):
+        if video_file:
+            BYTES_UPLOADED.labels('video').inc(video_file.size)
+        if message.video:
+            file_ids[url] = message.video.file_id
+            file_cache.set(video_cache_key(url), message.video.file_id)
+    return file_ids
+
+async def handle_video_links(update, context, user_id, urls):
+    """Несколько ссылок в одном сообщении: качаем параллельно и отправляем альбомом"""
+    # Каждая новая загрузка проходит лимиты пользователя и очереди, как одиночная ссылка
+    admitted = []
+    throttled = []
+    busy = []
+    new_downloads = 0
+    for url in urls:
+        video_key = video_cache_key(url)
+        if video_key in file_cache or video_key in download_flights:
+            admitted.append(url)
+            continue
+        try:
+            download_pool.admit(user_id, pending=new_downloads)
+        except ThrottledError:
+            throttled.append(url)
+            continue
+        except QueueFullError:
+            busy.append(url)
+            continue
+        new_downloads += 1
+        admitted.append(url)
+    
+    if not admitted:
+        await update.message.reply_text(get_text(user_id, 'throttled' if throttled else 'busy'))
+        return
+    urls = admitted
+
+    status_msg = await update.message.reply_text(get_text(user_id, 'downloading_video'))
+
+    # file_id после отправки альбома достается и тем, кто ждет эти же ссылки
+    loop = asyncio.get_running_loop()
+    uploaded = {url: loop.create_future() for url in urls}
+    file_ids = {}
+    try:
+        results = await asyncio.gather(
+            *(fetch_group_video(url, user_id, uploaded[url]) for url in urls),
+            return_exceptions=True
+        )
+
+        items = []
+        failed = []
+        too_large = []
+        unavailable = []
+        for url, result in zip(urls, results):
+            if isinstance(result, TooLargeError):
+                too_large.append(url)
+            elif isinstance(result, BreakerOpenError):
+                unavailable.append(url)
+            elif isinstance(result, BaseException):
+                ERRORS.labels('download').inc()
+                logger.error(f"Group video failed: {result!r}")
+                failed.append(url)
+            elif result[0] or result[1]:
+                items.append((url, *result))
+            else:
+                failed.append(url)
+
+        if items:
+            try:
+                file_ids = await send_video_group(
+                    context.bot, update.effective_chat.id, items, get_text(user_id, 'video_success')
+                )
+            except TelegramError as e:
+                ERRORS.labels('telegram_upload').inc()
+                logger.error(f"Error sending video group: {e}")
+                # Один устаревший file_id ломает весь альбом - забываем все из кэша
+                for url, file_id, _ in items:
+                    if file_id:
+                        file_cache.invalidate(video_cache_key(url))
+                failed.extend(url for url, _, _ in items)
+                items = []
+    finally:
+        for url, future in uploaded.items():
+            if not future.done():
+                future.set_result(file_ids.get(url))
+
+    notes = []
+    if throttled:
+        notes.append(get_text(user_id, 'throttled') + '\n' + '\n'.join(throttled))
+    if busy:
+        notes.append(get_text(user_id, 'busy') + '\n' + '\n'.join(busy))
+    if failed:
+        notes.append(get_text(user_id, 'videos_failed').format('\n'.join(failed)))
+    if too_large:
+        notes.append(get_text(user_id, 'too_large').format(UPLOAD_LIMIT // (1024 * 1024)) + '\n' + '\n'.join(too_large))
+    if unavailable:
+        notes.append(get_text(user_id, 'unavailable') + '\n' + '\n'.join(unavailable))
+
+    if not items:
+        await status_msg.edit_text('\n\n'.join(notes) or get_text(user_id, 'video_error'))
+        return
+
+    await status_msg.delete()
+    if notes:
+        await update.message.reply_text('\n\n'.join(notes))
 
 # Обработка текстовых сообщений (поиск или ссылки)
+@instrumented('handle_message')
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text
@@ -321,21 +1920,69 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Если это ссылка на видео
     if is_video_link(text):
-        status_msg = await update.message.reply_text(get_text(user_id, 'downloading_video'))
+        urls = extract_video_urls(text)
+        if len(urls) > 1:
+            await handle_video_links(update, context, user_id, urls)
+            return
+        # Ссылка без схемы (vm.tiktok.com/...) - передаем текст как есть
+        url = urls[0] if urls else text.strip()
+
+        # Это видео уже отправлялось - пересылаем по file_id
+        video_key = video_cache_key(url)
+        file_id = file_cache.get(video_key)
+        if file_id:
+            try:
+                with timed('cached_send'):
+                    await update.message.reply_video(
+                        video=file_id,
+                        supports_streaming=True,
+                        caption=get_text(user_id, 'video_success')
+                    )
+                return
+            except TelegramError as e:
+                ERRORS.labels('cached_send').inc()
+                logger.error(f"Cached video send failed: {e}")
+                file_cache.invalidate(video_key)
         
-        video_data = await download_video(text)
+        status_msg = await update.message.reply_text(get_text(user_id, 'downloading_video'))
         
-        if video_data:
-            try:
+        try:
+            # К уже идущей загрузке присоединяемся без проверки лимитов
+            if video_key not in download_flights:
+                video_breaker(url).check()
+                download_pool.admit(user_id)
+            file_id, shared = await download_flights.run(
+                video_key, fetch_and_send_video,
+                context.bot, update.effective_chat.id, url,
+                get_text(user_id, 'video_success'),
+                queue_notifier(status_msg, user_id), user_id
+            )
+            # Видео скачано для другого пользователя - отправляем по file_id
+            if file_id and shared:
                 await update.message.reply_video(
-                    video=video_data,
+                    video=file_id,
                     supports_streaming=True,
                     caption=get_text(user_id, 'video_success')
                 )
-                await status_msg.delete()
-            except Exception as e:
-                logger.error(f"Error sending video: {e}")
-                await status_msg.edit_text(get_text(user_id, 'video_error'))
+        except QueueFullError:
+            await status_msg.edit_text(get_text(user_id, 'busy'))
+            return
+        except ThrottledError:
+            await status_msg.edit_text(get_text(user_id, 'throttled'))
+            return
+        except TooLargeError:
+            await status_msg.edit_text(get_text(user_id, 'too_large').format(UPLOAD_LIMIT // (1024 * 1024)))
+            return
+        except BreakerOpenError:
+            await status_msg.edit_text(get_text(user_id, 'unavailable'))
+            return
+        except Exception as e:
+            ERRORS.labels('telegram_upload').inc()
+            logger.error(f"Error sending video: {e}")
+            file_id = None
+        
+        if file_id:
+            await status_msg.delete()
         else:
             await status_msg.edit_text(get_text(user_id, 'video_error'))
         
@@ -345,46 +1992,36 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = text
     status_msg = await update.message.reply_text(get_text(user_id, 'searching').format(query))
     
-    # Ищем музыку
-    results = await search_music(query)
+    # Ищем музыку: локальный каталог или Deezer
+    with timed('search'):
+        results = await find_tracks(query)
     
     if not results:
-        await status_msg.edit_text(get_text(user_id, 'no_results').format(query))
+        # Пустой ответ из-за недоступного Deezer - это не "ничего не найдено"
+        if get_breaker('deezer').state != 'closed':
+            await status_msg.edit_text(get_text(user_id, 'unavailable'))
+        else:
+            await status_msg.edit_text(get_text(user_id, 'no_results').format(query))
         return
     
     # Сохраняем результаты в контекст
-    context.user_data['search_results'] = results
+    sessions.set((user_id, 'search'), results)
     
     # Формируем сообщение с результатами
     text = get_text(user_id, 'found').format(len(results)) + '\n\n'
     
     for idx, track in enumerate(results[:10], 1):
-        artist = track.get('artist', {}).get('name', 'Unknown')
-        title = track.get('title', 'Unknown')
-        duration_sec = track.get('duration', 0)
-        duration_formatted = format_duration(duration_sec)
+        duration_formatted = format_duration(track.duration)
         # Добавляем длительность в строку
-        text += f"{idx}. {artist} - {title} ({duration_formatted})\n"
+        text += f"{idx}. {track.artist} - {track.title} ({duration_formatted})\n"
     
     text += '\n' + get_text(user_id, 'select')
     
     # Создаем клавиатуру с кнопками
-    keyboard = []
-    row = []
-    for i in range(1, min(len(results) + 1, 11)):
-        emoji_number = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟'][i-1]
-        row.append(InlineKeyboardButton(emoji_number, callback_data=f'download_{i-1}'))
-        
-        if len(row) == 3:
-            keyboard.append(row)
-            row = []
-    
-    if row:
-        keyboard.append(row)
-    
-    await status_msg.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    await status_msg.edit_text(text, reply_markup=build_track_keyboard(len(results), 'download'))
 
 # Обработка нажатий на кнопки
+@instrumented('button_callback')
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -394,13 +2031,15 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Изменение языка
     if query.data.startswith('lang_'):
         lang = query.data.split('_')[1]
-        user_settings[user_id] = {'lang': lang}
+        if lang not in TEXTS:
+            return
+        user_settings.set_lang(user_id, lang)
         await query.edit_message_text(get_text(user_id, 'lang_changed'))
         return
     
     # Проверка подписки
     if query.data == 'check_sub':
-        if await check_subscription(update, context):
+        if await check_subscription(update, context, force=True):
             await query.edit_message_text(get_text(user_id, 'subscribed'))
         else:
             await query.answer(get_text(user_id, 'subscribe'), show_alert=True)
@@ -414,30 +2053,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         track_index = int(query.data.split('_')[1])
-        results = context.user_data.get('top_results', [])
+        results = sessions.get((user_id, 'top'))
         
-        if track_index < len(results):
-            track = results[track_index]
-            track_id = track.get('id')
-            artist = track.get('artist', {}).get('name', 'Unknown')
-            title = track.get('title', 'Unknown')
-            
-            await query.edit_message_text(get_text(user_id, 'downloading'))
-            
-            audio_data = await download_music(track.get('link'), track_id)
-            
-            if audio_data:
-                await context.bot.send_audio(
-                    chat_id=user_id,
-                    audio=audio_data,
-                    title=title,
-                    performer=artist,
-                    duration=30,
-                    filename=f"{artist} - {title}.mp3"
-                )
-                await query.message.delete()
-            else:
-                await query.edit_message_text(get_text(user_id, 'error').format('Не удалось скачать трек'))
+        if results is None:
+            await query.edit_message_text(get_text(user_id, 'expired'))
+        elif track_index < len(results):
+            await send_track(query, context, user_id, results[track_index])
         return
     
     # Скачивание трека из поиска
@@ -448,44 +2069,225 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         track_index = int(query.data.split('_')[1])
-        results = context.user_data.get('search_results', [])
+        results = sessions.get((user_id, 'search'))
         
-        if track_index < len(results):
-            track = results[track_index]
-            track_id = track.get('id')
-            artist = track.get('artist', {}).get('name', 'Unknown')
-            title = track.get('title', 'Unknown')
-            
-            await query.edit_message_text(get_text(user_id, 'downloading'))
-            
-            # Скачиваем трек
-            audio_data = await download_music(track.get('link'), track_id)
-            
-            if audio_data:
-                # Отправляем аудио
-                await context.bot.send_audio(
-                    chat_id=user_id,
-                    audio=audio_data,
-                    title=title,
-                    performer=artist,
-                    duration=30,
-                    filename=f"{artist} - {title}.mp3"
-                )
-                await query.message.delete()
-            else:
-                await query.edit_message_text(get_text(user_id, 'error').format('Не удалось скачать трек'))
+        if results is None:
+            await query.edit_message_text(get_text(user_id, 'expired'))
+        elif track_index < len(results):
+            await send_track(query, context, user_id, results[track_index])
+
+# Скачивание и отправка выбранного трека
+async def send_track(query, context, user_id, track):
+    track_id = track.id
+    artist = track.artist
+    title = track.title
+    
+    # Трек уже отправлялся - пересылаем по file_id
+    track_key = track_cache_key(track_id)
+    file_id = file_cache.get(track_key)
+    if file_id:
+        try:
+            with timed('cached_send'):
+                await context.bot.send_audio(chat_id=user_id, audio=file_id, title=title, performer=artist)
+            await query.message.delete()
+            return
+        except TelegramError as e:
+            ERRORS.labels('cached_send').inc()
+            logger.error(f"Cached audio send failed: {e}")
+            file_cache.invalidate(track_key)
+    
+    await query.edit_message_text(get_text(user_id, 'downloading'))
+    
+    # Скачиваем трек через общий пул загрузок
+    try:
+        # К уже идущей загрузке присоединяемся без проверки лимитов
+        if track_key not in download_flights:
+            get_breaker('youtube').check()
+            download_pool.admit(user_id)
+        file_id, shared = await download_flights.run(
+            track_key, fetch_and_send_audio,
+            context.bot, user_id, track,
+            queue_notifier(query.message, user_id), user_id
+        )
+    except QueueFullError:
+        await query.edit_message_text(get_text(user_id, 'busy'))
+        return
+    except ThrottledError:
+        await query.edit_message_text(get_text(user_id, 'throttled'))
+        return
+    except BreakerOpenError:
+        await query.edit_message_text(get_text(user_id, 'unavailable'))
+        return
+    except Exception as e:
+        ERRORS.labels('telegram_upload').inc()
+        logger.error(f"Error sending track: {e}")
+        file_id = None
+    
+    if file_id:
+        # Трек скачан для другого пользователя - отправляем по file_id
+        if shared:
+            await context.bot.send_audio(chat_id=user_id, audio=file_id, title=title, performer=artist)
+        await query.message.delete()
+    else:
+        await query.edit_message_text(get_text(user_id, 'error').format('Не удалось скачать трек'))
+
+# Inline-режим (@bot название): ответ только из кэшей, без загрузок
+INLINE_PAGE_SIZE = 10
+INLINE_SEARCH_LIMIT = 50
+# Сколько ждать Deezer, если запроса нет в кэше; поиск продолжится в фоне
+INLINE_SEARCH_TIMEOUT = float(os.environ.get('INLINE_SEARCH_TIMEOUT', 0.7))
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', 300))
+# Треки из inline-ответов для перехода в бота по ссылке /start track_<id>
+inline_tracks = TTLCache(SESSION_MAX_USERS, SESSION_TTL)
+
+async def inline_search(query):
+    """Результаты из кэша поиска; без кэша ждем Deezer не дольше INLINE_SEARCH_TIMEOUT"""
+    key = normalize_query(query)
+    results = search_cache.get((key, INLINE_SEARCH_LIMIT))
+    if results is None:
+        # Тот же запрос мог искаться в личке с меньшим лимитом
+        results = search_cache.get((key, 10))
+    if results is not None:
+        return results
+    try:
+        return await asyncio.wait_for(search_music(key, INLINE_SEARCH_LIMIT), INLINE_SEARCH_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+
+def inline_result(track, user_id, bot_username):
+    """Трек с file_id отправляется сразу, остальные - ссылкой на скачивание в боте"""
+    file_id = file_cache.get(track_cache_key(track.id))
+    if file_id:
+        return InlineQueryResultCachedAudio(id=f"audio_{track.id}", audio_file_id=file_id)
+    
+    inline_tracks.set(str(track.id), track)
+    name = f"{track.artist} - {track.title}"
+    keyboard = [[InlineKeyboardButton(
+        get_text(user_id, 'inline_download'),
+        url=f"https://t.me/{bot_username}?start=track_{track.id}"
+    )]]
+    return InlineQueryResultArticle(
+        id=f"track_{track.id}",
+        title=name,
+        description=format_duration(track.duration),
+        input_message_content=InputTextMessageContent(f"🎵 {name}"),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+@instrumented('inline_query')
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    query = update.inline_query
+    
+    if not await check_subscription(update, context):
+        await query.answer(
+            [], cache_time=0, is_personal=True,
+            button=InlineQueryResultsButton(get_text(user_id, 'check_sub'), start_parameter='subscribe')
+        )
+        return
+    
+    # Пустой запрос - показываем топ
+    text = query.query.strip()
+    tracks = await inline_search(text) if text else top_state['tracks']
+    if not tracks:
+        # Поиск еще идет - Telegram повторит запрос, и ответ уже будет в кэше
+        await query.answer([], cache_time=0)
+        return
+    
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    page = tracks[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(tracks) else ''
+    await query.answer(
+        [inline_result(track, user_id, context.bot.username) for track in page],
+        cache_time=INLINE_CACHE_TIME,
+        # Кнопки на языке пользователя, поэтому кэш Telegram - на каждого свой
+        is_personal=True,
+        next_offset=next_offset
+    )
+
+# Прогрев воркеров yt-dlp при старте бота
+async def post_init(application):
+    if YTDLP_ENGINE == 'pool':
+        ytdlp_pool.start()
+
+# Закрытие общих ресурсов при остановке бота
+async def post_shutdown(application):
+    if http_client is not None:
+        await http_client.aclose()
+    await track_catalog.flush_async()
+    ytdlp_pool.stop()
 
 # Обработка ошибок
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ERRORS.labels(type(context.error).__name__).inc()
     logger.error(f"Update {update} caused error {context.error}")
 
-def main():
-    # Запускаем Flask в отдельном потоке
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    
-    # Создаем приложение бота
-    application = Application.builder().token(BOT_TOKEN).build()
+# Состояние пулов и кэшей для /metrics
+class BotStatsCollector:
+    """Отдает счетчики кэшей и текущую нагрузку при каждом запросе /metrics"""
+
+    def collect(self):
+        hits = CounterMetricFamily('bot_cache_hits', 'Cache hits', labels=['cache'])
+        misses = CounterMetricFamily('bot_cache_misses', 'Cache misses', labels=['cache'])
+        for name, cache in [
+            ('file_id', file_cache),
+            ('search', search_cache),
+            ('subscription', subscription_cache),
+            ('youtube_index', youtube_index)
+        ]:
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+        yield hits
+        yield misses
+        
+        pool = download_pool.stats()
+        in_flight = GaugeMetricFamily('bot_jobs_in_flight', 'Jobs in progress', labels=['kind'])
+        in_flight.add_metric(['download_active'], pool['active'])
+        in_flight.add_metric(['download_queued'], pool['queued'])
+        in_flight.add_metric(['download_flights'], len(download_flights.calls))
+        in_flight.add_metric(['search_flights'], len(search_flights.calls))
+        yield in_flight
+        yield GaugeMetricFamily('bot_media_in_flight_bytes', 'Downloaded bytes waiting for upload', value=media_budget.used)
+        
+        admission = CounterMetricFamily('bot_download_admission', 'Downloads refused by admission control', labels=['result'])
+        admission.add_metric(['throttled'], pool['throttled'])
+        admission.add_metric(['rejected'], pool['rejected'])
+        yield admission
+        yield CounterMetricFamily('bot_downloads_coalesced', 'Downloads saved by single-flight', value=download_flights.saved)
+        
+        state = GaugeMetricFamily('bot_circuit_state', 'Circuit breaker state: 0 closed, 1 half-open, 2 open', labels=['dependency'])
+        trips = CounterMetricFamily('bot_circuit_trips', 'Times a circuit breaker opened', labels=['dependency'])
+        rejected = CounterMetricFamily('bot_circuit_rejected', 'Calls refused by an open circuit breaker', labels=['dependency'])
+        for name, breaker in list(breakers.items()):
+            state.add_metric([name], CircuitBreaker.STATES[breaker.state])
+            trips.add_metric([name], breaker.trips)
+            rejected.add_metric([name], breaker.rejected)
+        yield state
+        yield trips
+        yield rejected
+        
+        retries = CounterMetricFamily('bot_retries', 'Retries and hedged requests by retry budget decision', labels=['dependency', 'result'])
+        for name, budget in [('deezer', search_retry_budget), ('ytdlp', download_retry_budget)]:
+            retries.add_metric([name, 'sent'], budget.retries)
+            retries.add_metric([name, 'refused'], budget.refused)
+        yield retries
+        
+        catalog = track_catalog.stats()
+        yield GaugeMetricFamily('bot_catalog_tracks', 'Tracks in the local search catalog', value=catalog['size'])
+        answers = CounterMetricFamily('bot_catalog_answers', 'Searches answered from the local catalog', labels=['kind'])
+        answers.add_metric(['confident'], catalog['answered'])
+        answers.add_metric(['fallback'], catalog['fallbacks'])
+        yield answers
+
+REGISTRY.register(BotStatsCollector())
+
+# Создание приложения бота с обработчиками
+def build_application():
+    # Обновления обрабатываются параллельно, чтобы загрузки не блокировали других пользователей
+    builder = Application.builder().token(BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES).post_init(post_init).post_shutdown(post_shutdown)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    application = builder.build()
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
@@ -493,9 +2295,84 @@ def main():
     application.add_handler(CommandHandler("top", top_hits))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
     application.add_error_handler(error_handler)
     
+    # Фоновое обновление топа и каталога треков
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(refresh_top_job, interval=TOP_REFRESH_INTERVAL, first=0)
+        application.job_queue.run_repeating(flush_catalog_job, interval=CATALOG_FLUSH_INTERVAL)
+        application.job_queue.run_repeating(expire_catalog_job, interval=CATALOG_EXPIRE_INTERVAL)
+    else:
+        logger.warning("JobQueue is not available, /top will be refreshed on demand")
+    
+    return application
+
+# Бот в фоновом потоке со своим event loop (для gunicorn и режима webhook)
+bot_application = None
+bot_loop = None
+bot_ready = threading.Event()
+
+async def start_bot(application):
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    
+    if BOT_MODE == 'webhook':
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    
+    await application.start()
+    logger.info(f"Bot started in {BOT_MODE} mode!")
+
+def run_bot_thread():
+    global bot_application, bot_loop
+    bot_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(bot_loop)
+    bot_application = build_application()
+    bot_loop.run_until_complete(start_bot(bot_application))
+    bot_ready.set()
+    bot_loop.run_forever()
+
+# Прием обновлений от Telegram в режиме webhook
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def webhook():
+    if BOT_MODE != 'webhook':
+        return 'Not found', 404
+    if not secrets.compare_digest(request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), WEBHOOK_SECRET):
+        return 'Forbidden', 403
+    # Telegram повторит запрос, если бот еще запускается
+    if not bot_ready.is_set():
+        return 'Bot is starting', 503
+    
+    update = Update.de_json(request.get_json(force=True), bot_application.bot)
+    asyncio.run_coroutine_threadsafe(bot_application.update_queue.put(update), bot_loop)
+    return 'ok'
+
+# Точка входа для gunicorn: gunicorn 'main:create_app()'
+def create_app():
+    threading.Thread(target=run_bot_thread, daemon=True).start()
+    return app
+
+def main():
+    if BOT_MODE == 'webhook':
+        # Бот в фоне, Flask принимает webhook в основном потоке
+        threading.Thread(target=run_bot_thread, daemon=True).start()
+        run_flask()
+        return
+    
+    # Запускаем Flask в отдельном потоке
+    flask_thread = threading.Thread(target=run_flask, daemon=True)
+    flask_thread.start()
+    
     # Запускаем бота
+    application = build_application()
     logger.info("Bot started!")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py читает настройки при импорте: отдельная база и фиктивный токен
+os.environ.setdefault('BOT_TOKEN', '123456:test')
+os.environ['CACHE_DB'] = os.path.join(tempfile.mkdtemp(), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Подменяет time.monotonic в main: тест сам двигает время"""
+    fake = FakeClock()
+    monkeypatch.setattr(main.time, 'monotonic', fake)
+    return fake
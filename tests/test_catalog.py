@@ -0,0 +1,66 @@
+"""Локальный каталог треков: запись, поиск по триграммам и устаревание"""
+import asyncio
+import sqlite3
+import time
+
+import main
+
+
+def make_catalog(ttl=3600):
+    db = sqlite3.connect(':memory:', isolation_level=None, check_same_thread=False)
+    return main.TrackCatalog(db, ttl)
+
+
+def track(track_id, artist, title):
+    return main.TrackRecord(track_id, artist, title, 200, f'https://www.deezer.com/track/{track_id}')
+
+
+def fill(catalog, tracks):
+    async def scenario():
+        catalog.add(tracks)
+        return await catalog.flush_async()
+
+    return asyncio.run(scenario())
+
+
+def test_search_prefers_exact_title_over_longer_one():
+    catalog = make_catalog()
+    fill(catalog, [
+        track(1, 'Queen', 'Bohemian Rhapsody'),
+        track(2, 'Queen', 'Bohemian Rhapsody (Live Aid 1985 Remastered)'),
+        track(3, 'ABBA', 'Dancing Queen'),
+    ])
+
+    results = catalog.search('queen bohemian rhapsody')
+    ids = [found.id for _, _, found in results]
+    assert ids[:2] == ['1', '2']
+    # Весь запрос есть в обоих треках, но у длинного названия меньше покрытие
+    (score1, coverage1, _), (score2, coverage2, _) = results[:2]
+    assert score1 == score2 == 1.0
+    assert coverage1 >= main.CATALOG_COVERAGE > coverage2
+    # Трек с одним общим словом остается ниже
+    assert results[2][0] < main.CATALOG_FALLBACK_SCORE
+
+
+def test_search_matches_unfinished_last_word_and_typo():
+    catalog = make_catalog()
+    fill(catalog, [track(1, 'Metallica', 'Nothing Else Matters')])
+
+    (score, _, found), = catalog.search('metallica nothing else mat')
+    assert found.id == '1' and score == 1.0
+    (score, _, _), = catalog.search('metalica nothing else matters')
+    assert main.CATALOG_FALLBACK_SCORE <= score < 1.0
+    assert catalog.search('...') == []
+
+
+def test_flush_counts_new_tracks_once_and_expire_removes_stale():
+    catalog = make_catalog(ttl=60)
+    assert fill(catalog, [track(1, 'Queen', 'Bohemian Rhapsody'), track(2, 'ABBA', 'Dancing Queen')]) == 2
+    # Повторно встреченный трек только продлевает seen_at
+    assert fill(catalog, [track(1, 'Queen', 'Bohemian Rhapsody')]) == 1
+    assert catalog.size == 2 and not catalog.pending
+
+    catalog.db.execute('UPDATE catalog_tracks SET seen_at = ? WHERE track_id = ?', (time.time() - 120, '2'))
+    assert catalog.expire() == 1
+    assert catalog.size == 1
+    assert [found.id for _, _, found in catalog.search('dancing queen')] == ['1']
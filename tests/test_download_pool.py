@@ -0,0 +1,121 @@
+"""Пул загрузок: очередь по кругу между пользователями, отмена задач, лимит запросов"""
+import asyncio
+
+import pytest
+
+import main
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def busy_pool():
+    """Пул с одним воркером, который уже занят: все новые задачи встают в очередь"""
+    pool = main.DownloadPool(1, 10)
+    pool.active = 1
+    return pool
+
+
+def test_cancelled_job_passes_handed_slot_on():
+    async def scenario():
+        pool = busy_pool()
+        ran = []
+
+        async def job(name):
+            ran.append(name)
+
+        cancelled = asyncio.ensure_future(pool.run(job, 'b', user_id=1))
+        waiting = asyncio.ensure_future(pool.run(job, 'c', user_id=2))
+        await settle()
+
+        # Воркер передан задаче b, но ее отменяют раньше, чем она проснулась
+        pool.release()
+        cancelled.cancel()
+        await waiting
+
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert ran == ['c']
+        assert pool.active == 0
+        assert pool.waiting == 0
+        assert not pool.queues
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_queued_job_leaves_queue():
+    async def scenario():
+        pool = busy_pool()
+        task = asyncio.ensure_future(pool.run(asyncio.sleep, 0, user_id=1))
+        await settle()
+        assert pool.waiting == 1
+
+        task.cancel()
+        await settle()
+        assert pool.waiting == 0
+        assert not pool.queues
+
+        pool.release()
+        assert pool.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_queue_notification_error_keeps_job():
+    async def scenario():
+        pool = busy_pool()
+        ran = []
+
+        async def job():
+            ran.append(True)
+
+        async def on_queued(position):
+            raise RuntimeError('RetryAfter')
+
+        task = asyncio.ensure_future(pool.run(job, on_queued=on_queued, user_id=1))
+        await settle()
+        pool.release()
+        await task
+        assert ran == [True]
+
+    asyncio.run(scenario())
+
+
+def test_round_robin_across_users():
+    async def scenario():
+        pool = busy_pool()
+        order = []
+
+        async def job(name):
+            order.append(name)
+
+        jobs = [(1, 'a1'), (1, 'a2'), (1, 'a3'), (2, 'b1'), (3, 'c1')]
+        tasks = [asyncio.ensure_future(pool.run(job, name, user_id=user_id)) for user_id, name in jobs]
+        await settle()
+
+        pool.release()
+        await asyncio.gather(*tasks)
+        assert order == ['a1', 'b1', 'c1', 'a2', 'a3']
+        assert pool.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_token_bucket_refill(clock):
+    bucket = main.TokenBucket(rate=0.5, capacity=2)
+    assert bucket.take()
+    assert bucket.take()
+    assert not bucket.take()
+
+    clock.now += 1
+    assert not bucket.take()
+    clock.now += 1
+    assert bucket.take()
+
+    # Запас не растет выше capacity
+    clock.now += 100
+    assert bucket.take()
+    assert bucket.take()
+    assert not bucket.take()
@@ -0,0 +1,119 @@
+"""Предохранители, бюджет повторов и дублирующие запросы"""
+import asyncio
+
+import pytest
+
+import main
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_breaker_half_open_reopens_then_closes(clock):
+    breaker = main.CircuitBreaker('test', failures=2, reset_timeout=10)
+    breaker.failure()
+    assert breaker.state == 'closed'
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    with pytest.raises(main.BreakerOpenError):
+        breaker.check()
+
+    # После reset_timeout пропускается один пробный вызов
+    clock.now += 10
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # Пробный вызов упал - снова открыт на reset_timeout
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert breaker.trips == 2
+
+    clock.now += 10
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+    assert breaker.rejected == 3
+
+
+def test_breaker_replaces_stuck_probe(clock):
+    breaker = main.CircuitBreaker('test', failures=1, reset_timeout=10)
+    breaker.failure()
+    clock.now += 10
+    assert breaker.allow()
+
+    # Пробный вызов не ответил за reset_timeout - пускаем следующий
+    clock.now += 10
+    assert breaker.allow()
+
+
+def test_retry_budget():
+    budget = main.RetryBudget(ratio=0.5, reserve=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    assert (budget.retries, budget.refused) == (2, 2)
+
+
+def test_hedged_request_cancels_slow_call():
+    async def scenario():
+        calls = []
+        cancelled = []
+
+        async def request():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(True)
+                    raise
+            return len(calls)
+
+        budget = main.RetryBudget(ratio=0.1, reserve=1)
+        assert await main.hedged_request(request, 0.01, budget) == 2
+        await settle()
+        assert cancelled == [True]
+        assert budget.retries == 1
+
+    asyncio.run(scenario())
+
+
+def test_hedged_request_without_budget_waits_for_first_call():
+    async def scenario():
+        calls = []
+
+        async def request():
+            calls.append(True)
+            await asyncio.sleep(0.05)
+            return 'first'
+
+        budget = main.RetryBudget(ratio=0.1, reserve=0)
+        assert await main.hedged_request(request, 0.01, budget) == 'first'
+        assert len(calls) == 1
+        assert budget.refused == 1
+
+    asyncio.run(scenario())
+
+
+def test_hedged_request_retries_failure_once():
+    async def scenario():
+        calls = []
+
+        async def request():
+            calls.append(True)
+            raise ValueError('boom')
+
+        budget = main.RetryBudget(ratio=0.1, reserve=5)
+        with pytest.raises(ValueError):
+            await main.hedged_request(request, 1, budget)
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+"""Выбор формата видео под лимит размера"""
+import main
+
+LIMIT = 50 * 1024 * 1024
+MB = 1024 * 1024
+
+
+def video(format_id, size=None, height=720, tbr=None, audio=False):
+    return {
+        'format_id': format_id, 'filesize': size, 'height': height, 'tbr': tbr,
+        'vcodec': 'avc1', 'acodec': 'mp4a' if audio else 'none'
+    }
+
+
+def audio(format_id, size=None, tbr=128):
+    return {'format_id': format_id, 'filesize': size, 'tbr': tbr, 'vcodec': 'none', 'acodec': 'mp4a'}
+
+
+def test_no_formats_left_to_ytdlp():
+    assert main.choose_video_format({'formats': []}, LIMIT) == f'best[filesize<?{LIMIT}]'
+
+
+def test_muxed_format_preferred_when_it_fits():
+    info = {'formats': [
+        video('18', 30 * MB, height=360, audio=True),
+        video('22', 80 * MB, height=1080, audio=True),
+        video('137', 40 * MB, height=1080),
+        audio('140', 5 * MB),
+    ]}
+    assert main.choose_video_format(info, LIMIT) == '18'
+
+
+def test_video_only_merged_with_best_fitting_audio():
+    info = {'formats': [
+        video('136', 20 * MB, height=720),
+        video('137', 45 * MB, height=1080),
+        audio('139', 2 * MB, tbr=48),
+        audio('140', 4 * MB, tbr=128),
+        audio('251', 10 * MB, tbr=160),
+    ]}
+    # 1080p + самая качественная дорожка, которая влезает в оставшиеся 5 МБ
+    assert main.choose_video_format(info, LIMIT) == f'137+140/best[filesize<?{LIMIT}]'
+
+
+def test_video_only_skipped_when_no_audio_fits():
+    info = {'formats': [video('137', 48 * MB), audio('140', 5 * MB)]}
+    assert main.choose_video_format(info, LIMIT) is None
+
+
+def test_nothing_fits():
+    info = {'formats': [video('22', 80 * MB, audio=True), video('137', 60 * MB)]}
+    assert main.choose_video_format(info, LIMIT) is None
+
+
+def test_unknown_audio_sizes_filtered_by_ytdlp():
+    info = {'formats': [video('137', 40 * MB), audio('140')]}
+    assert main.choose_video_format(info, LIMIT) == (
+        f'137+bestaudio[filesize<?{10 * MB}]/best[filesize<?{LIMIT}]'
+    )
+
+
+def test_unknown_sizes_filtered_by_ytdlp():
+    info = {'formats': [video('hls-720', audio=True)]}
+    assert main.choose_video_format(info, LIMIT) == f'best[filesize<?{LIMIT}]'
+    # Размер можно оценить по битрейту и длительности
+    info = {'duration': 600, 'formats': [video('hls-1080', tbr=1000, audio=True)]}
+    assert main.choose_video_format(info, LIMIT) is None
@@ -0,0 +1,101 @@
+"""Ссылки на видео: разбор сообщения и общие загрузки для альбома"""
+import asyncio
+
+import pytest
+
+import main
+
+
+class FakeVideo:
+    size = 1
+
+
+def test_group_download_joins_flight_started_in_same_tick(monkeypatch):
+    async def fake_run(job, *args, **kwargs):
+        await asyncio.sleep(0.01)
+        return FakeVideo()
+
+    monkeypatch.setattr(main.download_pool, 'run', fake_run)
+
+    async def scenario():
+        url = 'https://www.tiktok.com/@test/video/1001'
+        key = main.video_cache_key(url)
+        uploaded = asyncio.get_running_loop().create_future()
+
+        # Альбом начинает загрузку, одиночная ссылка приходит в том же такте
+        group = asyncio.ensure_future(main.fetch_group_video(url, 1, uploaded))
+        single = asyncio.ensure_future(main.download_flights.run(key, fake_run, None))
+
+        file_id, video_file = await asyncio.wait_for(group, 1)
+        assert file_id is None
+        assert isinstance(video_file, FakeVideo)
+
+        # Одиночный запрос получает file_id, когда альбом отправлен
+        uploaded.set_result('FILE')
+        assert await asyncio.wait_for(single, 1) == ('FILE', True)
+
+    asyncio.run(scenario())
+
+
+def test_group_download_joins_existing_flight():
+    async def scenario():
+        url = 'https://www.tiktok.com/@test/video/1002'
+        key = main.video_cache_key(url)
+
+        async def owner():
+            await asyncio.sleep(0.01)
+            return 'FILE'
+
+        single = asyncio.ensure_future(main.download_flights.run(key, owner))
+        await asyncio.sleep(0)
+        group = main.fetch_group_video(url, 1, asyncio.get_running_loop().create_future())
+
+        assert await asyncio.wait_for(group, 1) == ('FILE', None)
+        assert await single == ('FILE', False)
+
+    asyncio.run(scenario())
+
+
+def test_album_links_count_against_queue_limits():
+    pool = main.DownloadPool(1, 4)
+    pool.active = 1
+    admitted = 0
+    refused = []
+    # Ссылки одного сообщения допускаются по одной, с учетом уже допущенных
+    for _ in range(10):
+        try:
+            pool.admit(1, pending=admitted)
+            admitted += 1
+        except (main.ThrottledError, main.QueueFullError) as e:
+            refused.append(type(e))
+    assert admitted == min(main.USER_DOWNLOADS_BURST, main.USER_QUEUE_SIZE)
+    assert refused == [main.ThrottledError] * (10 - admitted)
+
+    # Общая очередь тоже учитывает ожидающие допуска задачи
+    pool.waiting = 3
+    with pytest.raises(main.QueueFullError):
+        pool.admit(2, pending=1)
+
+
+def test_extract_video_urls_strips_trailing_punctuation():
+    text = '(https://www.tiktok.com/@a/video/1), and https://instagram.com/p/x. see https://youtube.com/watch?v=1!'
+    assert main.extract_video_urls(text) == ['https://www.tiktok.com/@a/video/1', 'https://instagram.com/p/x']
+
+
+def test_extract_video_urls_deduplicates_and_caps():
+    text = ' '.join(
+        [f'https://www.tiktok.com/@a/video/{i}?utm_source=x' for i in range(12)]
+        + ['https://tiktok.com/@a/video/0']
+    )
+    urls = main.extract_video_urls(text)
+    assert len(urls) == main.MEDIA_GROUP_LIMIT
+    assert urls[0] == 'https://www.tiktok.com/@a/video/0?utm_source=x'
+
+
+def test_normalize_video_url():
+    assert main.normalize_video_url('look https://www.TikTok.com/@a/video/1/?utm_source=x&lang=en&q=1.') == (
+        'https://tiktok.com/@a/video/1?q=1'
+    )
+    assert main.normalize_video_url('https://m.instagram.com/reel/abc/?igshid=1') == 'https://instagram.com/reel/abc'
+    # Ключ кэша одинаков для ссылки с трекингом и без
+    assert main.video_cache_key('https://vm.tiktok.com/XYZ/?_r=1') == main.video_cache_key('https://vm.tiktok.com/XYZ')
@@ -0,0 +1,153 @@
+"""Процесс-воркер yt-dlp с прогретыми экземплярами YoutubeDL"""
+import re
+import resource
+import time
+
+# Аргументы командной строки (режим subprocess)
+CLI_ARGS = {
+    'video': [
+        '-f', 'best',
+        '--merge-output-format', 'mp4',
+        '--no-warnings',
+        '--quiet'
+    ],
+    # Только метаданные: форматы, размеры, длительность
+    'probe': [
+        '-J',
+        '-f', 'all',
+        '--no-warnings'
+    ],
+    # Перекодирование в MP3 через ffmpeg
+    'mp3': [
+        '--extract-audio',
+        '--audio-format', 'mp3',
+        '--no-playlist',
+        '--limit-rate', '5M'
+    ],
+    # M4A/AAC: дорожка AAC только перепаковывается, Opus и прочее перекодируются в AAC,
+    # иначе Telegram показывает файл документом или голосовым, а не аудио
+    'native': [
+        '-f', 'bestaudio[ext=m4a]/bestaudio',
+        '--extract-audio',
+        '--audio-format', 'm4a',
+        '--no-playlist',
+        '--limit-rate', '5M'
+    ]
+}
+
+# Те же настройки для yt_dlp.YoutubeDL (режим pool)
+OPTIONS = {
+    'video': {
+        'format': 'best',
+        'merge_output_format': 'mp4',
+        'quiet': True,
+        'no_warnings': True
+    },
+    'probe': {
+        'format': 'all',
+        'quiet': True,
+        'no_warnings': True
+    },
+    'mp3': {
+        'format': 'bestaudio/best',
+        'noplaylist': True,
+        'ratelimit': 5 * 1024 * 1024,
+        'quiet': True,
+        'no_warnings': True,
+        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3'}]
+    },
+    'native': {
+        'format': 'bestaudio[ext=m4a]/bestaudio',
+        'noplaylist': True,
+        'ratelimit': 5 * 1024 * 1024,
+        'quiet': True,
+        'no_warnings': True,
+        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'm4a'}]
+    }
+}
+
+# Классификация ошибок yt-dlp по тексту сообщения
+ERROR_PATTERNS = [
+    ('unsupported', re.compile(r'Unsupported URL|is not a valid URL', re.IGNORECASE)),
+    ('unavailable', re.compile(r'Video unavailable|Private|removed|not available|HTTP Error 404|login required', re.IGNORECASE)),
+    ('network', re.compile(r'timed out|Connection|HTTP Error 5\d\d|Unable to download webpage', re.IGNORECASE)),
+    ('format', re.compile(r'Requested format is not available|ffmpeg|ffprobe', re.IGNORECASE))
+]
+
+# Поля формата, которые нужны для выбора по размеру
+PROBE_FIELDS = ('format_id', 'ext', 'vcodec', 'acodec', 'height', 'tbr', 'filesize', 'filesize_approx')
+
+def compact_probe(info):
+    """Оставляет из ответа yt-dlp только длительность и форматы"""
+    return {
+        'duration': info.get('duration'),
+        'formats': [{key: f.get(key) for key in PROBE_FIELDS} for f in info.get('formats') or []]
+    }
+
+def classify_error(message):
+    for kind, pattern in ERROR_PATTERNS:
+        if pattern.search(message):
+            return kind
+    return 'error'
+
+def cpu_seconds():
+    """Процессорное время процесса вместе с дочерними (ffmpeg)"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def serve(conn):
+    """Цикл воркера: принимает (kind, target, outtmpl, format), отвечает (status, result, cpu, postprocess)
+
+    result - текст ошибки, а для kind='probe' - метаданные из compact_probe.
+    """
+    import yt_dlp
+    from yt_dlp.utils import DownloadError
+
+    # Время постобработки (ffmpeg) текущей задачи
+    postprocess = {'seconds': 0.0, 'started': {}}
+
+    def postprocessor_hook(d):
+        if d['status'] == 'started':
+            postprocess['started'][d['postprocessor']] = time.monotonic()
+        elif d['status'] == 'finished' and d['postprocessor'] in postprocess['started']:
+            postprocess['seconds'] += time.monotonic() - postprocess['started'].pop(d['postprocessor'])
+
+    # Экземпляры создаются один раз, экстракторы загружаются при старте процесса
+    instances = {
+        kind: yt_dlp.YoutubeDL(dict(
+            options,
+            outtmpl={'default': '%(id)s.%(ext)s'},
+            postprocessor_hooks=[postprocessor_hook]
+        ))
+        for kind, options in OPTIONS.items()
+    }
+    default_selectors = {kind: ydl.format_selector for kind, ydl in instances.items()}
+
+    while True:
+        try:
+            kind, target, outtmpl, format_spec = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        ydl = instances[kind]
+        cpu_start = cpu_seconds()
+        postprocess['seconds'] = 0.0
+        postprocess['started'].clear()
+        try:
+            # Формат, выбранный по метаданным, действует только на эту задачу
+            ydl.format_selector = ydl.build_format_selector(format_spec) if format_spec else default_selectors[kind]
+            if kind == 'probe':
+                status, message = 'ok', compact_probe(ydl.extract_info(target, download=False))
+            else:
+                ydl.params['outtmpl']['default'] = outtmpl
+                code = ydl.download([target])
+                if code == 0:
+                    status, message = 'ok', ''
+                else:
+                    status, message = 'error', f'yt-dlp returned {code}'
+        except DownloadError as e:
+            status, message = classify_error(str(e)), str(e)
+        except Exception as e:
+            status, message = 'error', repr(e)
+        conn.send((status, message, cpu_seconds() - cpu_start, postprocess['seconds']))